@@ -0,0 +1,36 @@
+import sys
+import timeit
+
+from modules.betting import Bet, BettingRoom
+
+OUTCOMES = ["yes", "no", "maybe"]
+
+def fill_room(bettors):
+    room = BettingRoom("bench", OUTCOMES, 0, "bench")
+    for player in range(1, bettors + 1):
+        room.add_bet(Bet(player, f"player{player}", OUTCOMES[player % len(OUTCOMES)], 10))
+    return room
+
+def main(bettors=10000, runs=5):
+    fill = min(timeit.repeat(lambda: fill_room(bettors), number=1, repeat=runs))
+    print(f"add_bet:   {bettors} bettors in {fill * 1000:.1f}ms ({fill / bettors * 1e6:.2f}us/bet)")
+
+    room = fill_room(bettors)
+    pools = min(timeit.repeat(lambda: dict(room.pools), number=1000, repeat=runs)) / 1000
+    print(f"pools:     {pools * 1e6:.2f}us")
+
+    winners = min(timeit.repeat(lambda: room.winners("yes"), number=1000, repeat=runs)) / 1000
+    print(f"winners:   {winners * 1e6:.2f}us")
+
+    dup = Bet(bettors, "dup", "yes", 10)
+    def reject():
+        try:
+            room.add_bet(dup)
+        except Exception:
+            pass
+    reject_time = min(timeit.repeat(reject, number=1000, repeat=runs)) / 1000
+    print(f"duplicate: {reject_time * 1e6:.2f}us")
+
+if __name__ == "__main__":
+    # python -m bench.betting [bettors]
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,220 @@
+# Just enough of discord.py's Context, guild, channel and voice client
+# for the cogs to run without a gateway connection.
+import asyncio
+import itertools
+import time
+from contextlib import contextmanager
+
+from modules import extractor as extractor_module
+from modules import player as player_module
+from modules.cache import ExtractionCache
+
+ids = itertools.count(1000)
+
+class FakeMessage:
+    def __init__(self, channel, embed=None, content=None) -> None:
+        self.id = next(ids)
+        self.channel = channel
+        self.embed = embed
+        self.content = content
+        self.sent_at = time.perf_counter()
+
+    async def edit(self, embed=None, content=None):
+        self.embed = embed or self.embed
+        self.content = content or self.content
+        self.channel.edits += 1
+
+    async def pin(self):
+        pass
+
+    async def unpin(self):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+class FakeChannel:
+    def __init__(self, channel_id=None) -> None:
+        self.id = channel_id or next(ids)
+        self.sent = []
+        self.edits = 0
+
+    async def send(self, content=None, *, embed=None):
+        message = FakeMessage(self, embed, content)
+        self.sent.append(message)
+        return message
+
+    async def fetch_message(self, message_id):
+        for message in self.sent:
+            if message.id == message_id:
+                return message
+        raise LookupError(message_id)
+
+class FakeVoiceClient:
+    """
+    Plays a source by calling `after` once `track_seconds` have passed.
+    """
+    def __init__(self, channel, track_seconds) -> None:
+        self.channel = channel
+        self.guild = channel.guild
+        self.track_seconds = track_seconds
+        self.connected = True
+        self.timer = None
+        self.after = None
+        self.played = []
+
+    def play(self, source, *, after=None):
+        self.played.append(source)
+        self.after = after
+        self.timer = asyncio.get_event_loop().call_later(self.track_seconds, self._finish)
+
+    def _finish(self):
+        self.timer = None
+        if self.after is not None:
+            self.after(None)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self._finish()
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.connected = False
+        self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild) -> None:
+        self.id = next(ids)
+        self.guild = guild
+
+    async def connect(self, timeout=60.0):
+        self.guild.voice_client = FakeVoiceClient(self, self.guild.track_seconds)
+        return self.guild.voice_client
+
+class FakeVoiceState:
+    def __init__(self, guild) -> None:
+        self.channel = FakeVoiceChannel(guild)
+
+class FakeGuild:
+    def __init__(self, track_seconds=0.05) -> None:
+        self.id = next(ids)
+        self.name = f"guild{self.id}"
+        self.track_seconds = track_seconds
+        self.voice_client = None
+        self.members = []
+
+class FakeUser:
+    def __init__(self, user_id=None, name=None) -> None:
+        self.id = user_id or next(ids)
+        self.name = name or f"user{self.id}"
+        self.avatar_url = ""
+        self.voice = None
+        self.dm = FakeChannel()
+
+    async def send(self, content=None, *, embed=None):
+        return await self.dm.send(content, embed=embed)
+
+class FakeContext:
+    def __init__(self, bot, author, channel, guild) -> None:
+        self.bot = bot
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.message = FakeMessage(channel)
+        self.command = None
+        self.command_failed = False
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, *, embed=None):
+        return await self.channel.send(content, embed=embed)
+
+    async def fetch_message(self, message_id):
+        return self.message
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.loop = asyncio.get_event_loop()
+        self.users = {}
+        self.channels = {}
+
+    def user(self, user_id=None, name=None, guild=None):
+        user = FakeUser(user_id, name)
+        if guild is not None:
+            user.voice = FakeVoiceState(guild)
+        self.users[user.id] = user
+        return user
+
+    def channel(self, channel_id=None):
+        channel = FakeChannel(channel_id)
+        self.channels[channel.id] = channel
+        return channel
+
+    def context(self, author, channel, guild=None):
+        return FakeContext(self, author, channel, guild or FakeGuild())
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id):
+        return self.users[user_id]
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def wait_until_ready(self):
+        pass
+
+class FakeSource:
+    def __init__(self, data) -> None:
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+
+def fake_extract_info(latency):
+    """
+    Stand-in for `modules.extractor.extract_info` that sleeps for
+    `latency` seconds in the pool worker and returns a plausible result.
+    """
+    def extract_info(url, download):
+        time.sleep(latency)
+        key = abs(hash(url))
+        return {
+            'id': str(key),
+            'title': url,
+            'url': f"https://example.invalid/{key}.webm",
+            'webpage_url': f"https://example.invalid/watch?v={key}",
+            'duration': 180,
+        }
+    return extract_info
+
+@contextmanager
+def fake_youtube(latency):
+    """
+    Run the music cog against `fake_extract_info` and FakeSource, with a
+    fresh extraction cache, putting the real ones back afterwards.
+    """
+    real_extract = extractor_module.extract_info
+    real_from_data = player_module.YTDLSource.from_data
+    extractor_module.extract_info = fake_extract_info(latency)
+    player_module.YTDLSource.from_data = staticmethod(lambda data, stream=True: FakeSource(data))
+    player_module.extraction_cache = ExtractionCache()
+    try:
+        yield
+    finally:
+        extractor_module.extract_info = real_extract
+        player_module.YTDLSource.from_data = real_from_data
@@ -0,0 +1,33 @@
+import random
+import sys
+import timeit
+
+from modules.ranking import Leaderboard
+
+def main(players=100000, runs=5):
+    balances = {player: random.randint(0, 100000) for player in range(players)}
+    build = min(timeit.repeat(lambda: Leaderboard(balances), number=1, repeat=runs))
+    print(f"build:     {players} wallets in {build * 1000:.1f}ms")
+
+    board = Leaderboard(balances)
+    def update():
+        board.update(random.randrange(players), random.randint(0, 100000))
+    updated = min(timeit.repeat(update, number=1000, repeat=runs)) / 1000
+    print(f"update:    {updated * 1e6:.2f}us")
+
+    top = min(timeit.repeat(lambda: board.top(0, 10), number=1000, repeat=runs)) / 1000
+    print(f"top 10:    {top * 1e6:.2f}us")
+
+    page = min(timeit.repeat(lambda: board.top(players // 2, players // 2 + 10), number=1000, repeat=runs)) / 1000
+    print(f"mid page:  {page * 1e6:.2f}us")
+
+    rank = min(timeit.repeat(lambda: board.rank(random.randrange(players)), number=1000, repeat=runs)) / 1000
+    print(f"rank:      {rank * 1e6:.2f}us")
+
+    # what a leaderboard costs without the index
+    scan = min(timeit.repeat(lambda: sorted(board.scores.items(), key=lambda kv: -kv[1])[:10], number=1, repeat=runs))
+    print(f"sort all:  {scan * 1e6:.2f}us")
+
+if __name__ == "__main__":
+    # python -m bench.leaderboard [players]
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
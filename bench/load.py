@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from modules import player as player_module
+from modules.betting import BettingModule
+from modules.ledger import Ledger
+from modules.rooms import RoomLog
+from modules.store import TextWalletStore
+from modules.wallet import WalletManager, WalletModule
+
+from bench.fakes import FakeBot, FakeGuild, fake_youtube
+
+class Recorder:
+    """
+    Collects per-command latencies for one scenario.
+    """
+    def __init__(self) -> None:
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.commands = 0
+        # wall time during which at least one command was in flight
+        self.busy = 0.0
+        self.in_flight = 0
+        self.busy_since = 0.0
+
+    async def timed(self, name, coro):
+        start = time.perf_counter()
+        if self.in_flight == 0:
+            self.busy_since = start
+        self.in_flight += 1
+        try:
+            await coro
+        except Exception:
+            self.failures[name] += 1
+        finally:
+            end = time.perf_counter()
+            self.latencies[name].append(end - start)
+            self.commands += 1
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.busy += end - self.busy_since
+
+    def observe(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def summary(self):
+        out = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            out[name] = {
+                "count": len(values),
+                "errors": self.failures[name],
+                "p50": percentile(values, 0.50),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return out
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def betting(rec, tmp, bettors=500, rooms=50):
+    """
+    `bettors` players get wallets, open `rooms` rooms, bet in a random
+    room each, check balances, then every room is settled.
+    """
+    bot = FakeBot()
+    wallet = WalletManager(
+        TextWalletStore(os.path.join(tmp, "wallets.txt"), os.path.join(tmp, "wallets.journal")),
+        Ledger(os.path.join(tmp, "wallets.ledger")))
+    bets = BettingModule(bot, wallet, RoomLog(os.path.join(tmp, "rooms.journal")))
+    wallets = WalletModule(bot, wallet)
+    guild = FakeGuild()
+
+    users = [bot.user() for _ in range(bettors)]
+    guild.members.extend(users)
+    channels = [bot.channel() for _ in range(rooms)]
+    ctx = lambda user, channel: bot.context(user, channel, guild)
+
+    await asyncio.gather(*(rec.timed("new-wallet", wallets.new_wallet(ctx(u, channels[0]))) for u in users))
+    await asyncio.gather(*(
+        rec.timed("bet-open", bets.bet(ctx(users[i], c), msg=f"Room {i} - yes or no"))
+        for i, c in enumerate(channels)))
+    await asyncio.gather(*(
+        rec.timed("bet", bets.bet(ctx(u, random.choice(channels)), msg=f"{random.choice(['yes', 'no', '1', '2'])} {random.randint(1, 100)}"))
+        for u in users))
+    await asyncio.gather(*(rec.timed("bet-running", bets.bet_running(ctx(users[0], c))) for c in channels))
+    await asyncio.gather(*(rec.timed("balance", wallets.balance(ctx(u, channels[0]))) for u in users))
+    await asyncio.gather(*(rec.timed("rank", wallets.rank(ctx(u, channels[0]))) for u in users))
+    await asyncio.gather(*(
+        rec.timed("leaderboard", wallets.leaderboard(ctx(u, random.choice(channels)), random.randint(1, 5)))
+        for u in users))
+    await asyncio.gather(*(rec.timed("history", wallets.history(ctx(u, channels[0]))) for u in users))
+    await asyncio.gather(*(
+        rec.timed("bet-winner", bets.bet_winner(ctx(users[i], c), msg=random.choice(["yes", "no"])))
+        for i, c in enumerate(channels)))
+
+    bets.cog_unload()
+    await bets.rooms.close()
+    await wallet.close()
+    return {"bettors": bettors, "rooms": rooms}
+
+async def play(rec, tmp, plays=200, guilds=100, latency=0.2, track=0.05, workers=16, premium=0.1):
+    """
+    `plays` concurrent `$play`/`$p-play` spread over `guilds` guilds
+    against an extractor that takes `latency` seconds per call. Also
+    records the time from command to "Now playing".
+    """
+    with fake_youtube(latency):
+        return await _play(rec, tmp, plays, guilds, latency, track, workers, premium)
+
+async def _play(rec, tmp, plays, guilds, latency, track, workers, premium):
+    bot = FakeBot()
+    wallet = WalletManager(TextWalletStore(os.path.join(tmp, "wallets.txt"), os.path.join(tmp, "wallets.journal")))
+    music = player_module.MusicModule(bot, wallet, None, "thread", workers)
+    guild_list = [FakeGuild(track) for _ in range(guilds)]
+    channels = {g.id: bot.channel() for g in guild_list}
+
+    started = {}
+    async def request(i):
+        guild = guild_list[i % guilds]
+        user = bot.user(guild=guild)
+        ctx = bot.context(user, channels[guild.id], guild)
+        query = f"song {i}"
+        started[query] = time.perf_counter()
+        if random.random() < premium:
+            await wallet.new_wallet(user.id, 500)
+            await music.ensure_voice(ctx)
+            await music.premium_play(ctx, val=query)
+        else:
+            await music.ensure_voice(ctx)
+            await music.play(ctx, val=query)
+
+    await asyncio.gather(*(rec.timed("play", request(i)) for i in range(plays)))
+
+    seen = set()
+    deadline = time.perf_counter() + 60 + plays * (latency + track)
+    while len(seen) < plays and time.perf_counter() < deadline:
+        for channel in channels.values():
+            for message in channel.sent:
+                if message.id in seen or message.embed is None or message.embed.title != "Now playing":
+                    continue
+                seen.add(message.id)
+                rec.observe("now-playing", message.sent_at - started[message.embed.description])
+        await asyncio.sleep(0.01)
+    if len(seen) < plays:
+        rec.failures["now-playing"] += plays - len(seen)
+
+    music.cog_unload()
+    await wallet.close()
+    return {"plays": plays, "guilds": guilds, "latency": latency, "track": track, "workers": workers}
+
+SCENARIOS = {
+    "betting": betting,
+    "play": play,
+}
+
+async def run(name, memory, options):
+    rec = Recorder()
+    if memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        params = await SCENARIOS[name](rec, tmp, **options.get(name, {}))
+        elapsed = time.perf_counter() - start
+    result = {
+        "scenario": name,
+        "params": params,
+        "commands": rec.commands,
+        "seconds": elapsed,
+        "command_seconds": rec.busy,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "latency": rec.summary(),
+    }
+    result["commands_per_sec"] = rec.commands / rec.busy if rec.busy else None
+    if memory:
+        result["peak_traced_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+def compare(old, new):
+    """
+    Print p50/p99 for every command in `new` next to the same run in `old`.
+    """
+    before = {r["scenario"]: r for r in old}
+    for result in new:
+        prev = before.get(result["scenario"])
+        if prev is None:
+            continue
+        print(f"{result['scenario']}: {prev['commands_per_sec']:.0f} -> {result['commands_per_sec']:.0f} commands/s")
+        for name, stats in result["latency"].items():
+            was = prev["latency"].get(name)
+            if was is None:
+                continue
+            for q in ("p50", "p99"):
+                if was[q] and stats[q]:
+                    print(f"  {name} {q}: {was[q] * 1000:.2f}ms -> {stats[q] * 1000:.2f}ms ({stats[q] / was[q]:.2f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against fake Discord and youtube_dl")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to diff against")
+    parser.add_argument("--memory", action="store_true", help="trace Python allocations (slows the run)")
+    parser.add_argument("--latency", type=float, help="seconds per fake extraction")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    random.seed(args.seed)
+    options = {}
+    if args.latency is not None:
+        options["play"] = {"latency": args.latency}
+
+    # the scheduler wheel keeps its timer handle between scenarios, so they share one loop rather than asyncio.run each
+    loop = asyncio.get_event_loop()
+    results = [loop.run_until_complete(run(name, args.memory, options)) for name in args.scenarios or SCENARIOS]
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    # python -m bench.load [betting] [play] [--out results.json] [--compare old.json]
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import argparse
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+import discord
+
+from modules.player import YTDLSource, YTDLOpusSource
+
+FRAMES_PER_SECOND = 50
+
+def make_track(path, seconds):
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-ac", "2", "-ar", "48000", "-c:a", "libopus", path],
+        check=True)
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def play(make_source, streams, seconds):
+    """
+    Pull `seconds` of frames from `streams` sources the way a voice client
+    does, encoding PCM frames with libopus, and return the bot's and
+    FFmpeg's CPU seconds.
+    """
+    sources = [make_source() for _ in range(streams)]
+    encoder = discord.opus.Encoder()
+    cpu = time.process_time()
+    ffmpeg = children_cpu()
+    for _ in range(seconds * FRAMES_PER_SECOND):
+        for source in sources:
+            data = source.read()
+            if data and not source.is_opus():
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+    bot_cpu = time.process_time() - cpu
+    for source in sources:
+        source.cleanup()
+    return bot_cpu, children_cpu() - ffmpeg
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU per stream for PCM and Opus passthrough playback")
+    parser.add_argument("track", nargs="?", help="audio file to play (default: a generated Opus tone)")
+    parser.add_argument("--streams", type=int, default=8)
+    parser.add_argument("--seconds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        track = args.track
+        if track is None:
+            track = os.path.join(tmp, "tone.opus")
+            make_track(track, args.seconds + 5)
+        data = {'title': "bench", 'url': track, 'acodec': 'opus'}
+
+        for name, make_source in (
+                ("pcm", lambda: YTDLSource.from_file(track, data)),
+                ("opus", lambda: YTDLOpusSource.from_file(track, data))):
+            bot_cpu, ffmpeg_cpu = play(make_source, args.streams, args.seconds)
+            audio = args.streams * args.seconds
+            print(
+                f"{name:5} bot {bot_cpu / audio * 1000:.2f}ms + ffmpeg {ffmpeg_cpu / audio * 1000:.2f}ms "
+                f"CPU per stream-second ({args.streams} streams)")
+
+if __name__ == "__main__":
+    # python -m bench.playback [track] [--streams N] [--seconds S]
+    main()
@@ -0,0 +1,44 @@
+import asyncio
+import random
+import sys
+import time
+
+from modules.scheduler import TimingWheel
+
+# Deadlines spread like room expiries: anywhere up to 30 days out
+HORIZON = 30 * 24 * 60 * 60
+# Ticks stepped per measurement, an hour at the default resolution
+STEPS = 3600
+
+def fill(timers):
+    wheel = TimingWheel()
+    now = time.time()
+    fired = []
+    start = time.perf_counter()
+    handles = [wheel.schedule(now + random.uniform(1, HORIZON), lambda: fired.append(1)) for _ in range(timers)]
+    elapsed = time.perf_counter() - start
+    return wheel, handles, fired, elapsed
+
+async def main(sizes):
+    for timers in sizes:
+        wheel, handles, fired, schedule = fill(timers)
+        # stop the real clock and step by hand, so the run doesn't take an hour
+        wheel.stop()
+        start = time.perf_counter()
+        for _ in range(STEPS):
+            wheel._step()
+        step = (time.perf_counter() - start) / STEPS
+
+        start = time.perf_counter()
+        for timer in handles:
+            timer.cancel()
+        cancel = time.perf_counter() - start
+        print(
+            f"{timers:>7} timers: schedule {schedule / timers * 1e6:.2f}us, "
+            f"tick {step * 1e6:.2f}us ({len(fired)} fired in {STEPS} ticks), "
+            f"cancel {cancel / timers * 1e6:.2f}us")
+
+if __name__ == "__main__":
+    # python -m bench.scheduler [timers ...]
+    random.seed(0)
+    asyncio.run(main([int(n) for n in sys.argv[1:]] or (1000, 10000, 100000)))
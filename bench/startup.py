@@ -0,0 +1,56 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Seconds from interpreter start to a fully built bot, ready to connect
+STARTUP_BUDGET = 1.5
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+bot = main.build_bot()
+built = time.perf_counter()
+# let the background loads finish so they can be timed too
+bot.loop.run_until_complete(bot.wallet.ready())
+loaded = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "build": built - imported,
+    "wallet_ready": loaded - built,
+    "youtube_dl_loaded": "youtube_dl" in sys.modules,
+    "pydoc_loaded": "pydoc" in sys.modules,
+}))
+"""
+
+def probe():
+    out = subprocess.run([sys.executable, "-c", PROBE], check=True, stdout=subprocess.PIPE, text=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Time imports and bot construction against a budget")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    best = min(runs, key=lambda r: r["import"] + r["build"])
+    startup = best["import"] + best["build"]
+    print(json.dumps(dict(best, startup=startup, budget=args.budget), indent=2))
+
+    failures = []
+    if startup > args.budget:
+        failures.append(f"startup took {startup:.3f}s, budget is {args.budget:.3f}s")
+    if best["youtube_dl_loaded"]:
+        failures.append("youtube_dl was imported before the first music command")
+    if best["pydoc_loaded"]:
+        failures.append("pydoc was imported at startup")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    # python -m bench.startup [--runs N] [--budget SECONDS]; exits 1 when over budget
+    sys.exit(main())
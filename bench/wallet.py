@@ -0,0 +1,184 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from modules.betting import BettingModule
+from modules.errors import InvalidCommandUsage
+from modules.ledger import Ledger, RECORD, REASONS, audit
+from modules.outbox import outbox
+from modules.player import MusicModule, PREMIUM_COST
+from modules.rooms import RoomLog
+from modules.store import TextWalletStore, SqliteWalletStore
+from modules.wallet import WalletManager
+
+from bench.fakes import FakeBot, FakeGuild, fake_youtube
+
+START_BALANCE = 500
+OUTCOMES = ["yes", "no"]
+
+def ledger_totals(path):
+    """
+    Net change per reason across the whole ledger.
+    """
+    totals = Counter()
+    with open(path, "rb") as f:
+        for (_, _, _, change, _, code) in RECORD.iter_unpack(f.read()):
+            totals[REASONS[code]] += change
+    return totals
+
+async def stress(make_wallet, ledger_file, room_log, players=1000, rooms=20, ops=20000):
+    """
+    Fire `ops` concurrent `$bet`s and `$p-play`s through the cogs, with
+    half the rooms declaring a winner part-way through, then settle the
+    rest. Checks that every stake taken is in a room or was refunded,
+    that winners got exactly their payouts, and that nothing else moved.
+    """
+    bot = FakeBot()
+    guild = FakeGuild(track_seconds=0)
+    users = [bot.user(guild=guild) for _ in range(players)]
+    channels = [bot.channel() for _ in range(rooms)]
+    ctx = lambda user, channel: bot.context(user, channel, guild)
+
+    # open the wallets, then restart like the bot would, so a lazy store
+    # loads each player on first use and bets can race their room closing
+    wallet = make_wallet()
+    await asyncio.gather(*(wallet.new_wallet(user.id, START_BALANCE) for user in users))
+    await wallet.close()
+    wallet = make_wallet()
+    bets = BettingModule(bot, wallet, RoomLog(room_log))
+    music = MusicModule(bot, wallet, None, "thread", 4)
+
+    for i, channel in enumerate(channels):
+        await bets.bet(ctx(users[i], channel), msg=f"room {i} - yes or no")
+    opened = list(bets.curr_bets.values())
+    winning = {room.id: random.choice(OUTCOMES) for room in opened}
+    await music.ensure_voice(ctx(users[0], channels[0]))
+
+    rejected = 0
+    async def command(coro):
+        nonlocal rejected
+        try:
+            await coro
+        except InvalidCommandUsage:
+            # betting in a channel whose room has already been settled
+            rejected += 1
+
+    def declare(i):
+        room = opened[i]
+        return bets.bet_winner(ctx(users[i], channels[i]), msg=winning[room.id])
+
+    jobs = []
+    for n in range(ops):
+        user = random.choice(users)
+        channel = random.choice(channels)
+        if random.random() < 0.2:
+            jobs.append(music.premium_play(ctx(user, channel), val=f"song {n}"))
+        else:
+            jobs.append(bets.bet(ctx(user, channel), msg=f"{random.choice(OUTCOMES)} {random.randint(1, 100)}"))
+    # rooms that close while bets against them are still withdrawing
+    for i in range(0, rooms, 2):
+        jobs.insert(random.randrange(len(jobs) // 2, len(jobs)), declare(i))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(command(job) for job in jobs))
+    await asyncio.gather(*(declare(i) for i in range(1, rooms, 2)))
+    elapsed = time.perf_counter() - start
+    await outbox.close()
+    await wallet.ledger.commit()
+    music.cog_unload()
+    bets.cog_unload()
+    await bets.rooms.close()
+
+    totals = ledger_totals(ledger_file)
+    staked = -totals["stake"]
+    refunded = totals["refund"]
+    assert staked - refunded == sum(room.total for room in opened), \
+        f"stakes off: {staked} taken, {refunded} refunded, {sum(room.total for room in opened)} in rooms"
+    paid = sum(
+        int(round(bet.amount + bet.amount * room.payout_ratio(winning[room.id])))
+        for room in opened for bet in room.winners(winning[room.id]))
+    assert totals["payout"] == paid, f"payouts off: {totals['payout']} != {paid}"
+    purchases = sum(
+        message.embed is not None and message.embed.title == "A premium play has been purchased"
+        for channel in channels for message in channel.sent)
+    assert -totals["premium"] == purchases * PREMIUM_COST, "premium plays off"
+
+    balances = {user.id: await wallet.balance(user.id) for user in users}
+    expected = players * START_BALANCE - staked + refunded + paid - purchases * PREMIUM_COST
+    assert min(balances.values()) >= 0, "negative balance"
+    assert sum(balances.values()) == expected, f"balances off: {sum(balances.values())} != {expected}"
+    print(
+        f"  {len(jobs)} commands ({rejected} rejected) in {elapsed * 1000:.0f}ms, "
+        f"{refunded} coins refunded from raced bets, balances at {expected}")
+    await wallet.close()
+    return balances
+
+async def run(name, make_store, ledger_file, room_log):
+    print(name)
+    with fake_youtube(0):
+        balances = await stress(lambda: WalletManager(make_store(), Ledger(ledger_file)), ledger_file, room_log)
+    problems = audit(ledger_file, balances)
+    assert not problems, problems[:5]
+    print("  ledger replays to every balance")
+
+    reopened = WalletManager(make_store())
+    stored = {p: await reopened.balance(p) for p in balances}
+    await reopened.close()
+    assert stored == balances, "store does not match memory after close"
+    print("  store matches memory after reopen")
+
+async def crash(wallet):
+    """
+    Get everything `wallet` has taken to disk, then drop it without the
+    compaction a clean close would do.
+    """
+    await wallet.store.flush()
+    await wallet.ledger.commit()
+
+async def torn_tail(tmp):
+    """
+    Crash part-way through writing the journal and the ledger, carry on,
+    crash again, and check the reopened wallet kept every commit.
+    """
+    print("torn tail")
+    journal_file = os.path.join(tmp, "torn.journal")
+    ledger_file = os.path.join(tmp, "torn.ledger")
+    make_store = lambda: TextWalletStore(os.path.join(tmp, "torn.txt"), journal_file)
+
+    wallet = WalletManager(make_store(), Ledger(ledger_file))
+    await wallet.new_wallet(1, START_BALANCE)
+    await crash(wallet)
+    with open(journal_file, "a") as f:
+        f.write("2 w 1 4")
+    with open(ledger_file, "ab") as f:
+        f.write(b"\0" * 10)
+
+    restarted = WalletManager(make_store(), Ledger(ledger_file))
+    await restarted.deposit(1, 7)
+    await crash(restarted)
+
+    reopened = WalletManager(make_store())
+    balance = await reopened.balance(1)
+    await reopened.close()
+    assert balance == START_BALANCE + 7, f"torn record replayed: {balance} != {START_BALANCE + 7}"
+    problems = audit(ledger_file, {1: balance})
+    assert not problems, problems
+    print("  torn records are dropped, not glued to the next commit")
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        await run("text", lambda: TextWalletStore(
+            os.path.join(tmp, "wallets.txt"), os.path.join(tmp, "wallets.journal")),
+            os.path.join(tmp, "text.ledger"), os.path.join(tmp, "text.rooms"))
+        await run("sqlite", lambda: SqliteWalletStore(os.path.join(tmp, "wallets.db")),
+            os.path.join(tmp, "sqlite.ledger"), os.path.join(tmp, "sqlite.rooms"))
+        await torn_tail(tmp)
+
+if __name__ == "__main__":
+    # python -m bench.wallet [seed]
+    random.seed(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    asyncio.run(main())
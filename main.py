@@ -3,6 +3,7 @@ import discord
 from discord.ext import commands
 from discord.utils import find
 
+import multiprocessing
 import os
 from modules.embed import COLOUR
 
@@ -10,6 +11,12 @@ from modules.player import MusicModule
 from modules.errors import CommandErrHandler
 from modules.betting import BettingModule
 from modules.wallet import WalletManager, WalletModule
+from modules.store import TextWalletStore, SqliteWalletStore, WALLET_DB
+from modules.ledger import Ledger, LEDGER_FILE
+from modules.rooms import RoomLog, ROOM_LOG
+from modules.cache import AUDIO_CACHE_SIZE
+from modules.metrics import MetricsModule
+from modules.outbox import outbox
 
 CHIMP_GREETING_TITLE = "Chimp-bot - for being a general ape."
 
@@ -22,9 +29,20 @@ Popular commands to get started:
     - `$play <song>` to stream a song to your voice channel.
     - `$p-play <song>` to spend Chimp-coin and bypass the song queue.
     - `$bet <premise> - <outcome> or <outcome>` to start a betting room (Ex: `$bet He is going to feed - yes or no`).
+      Add ` | 10m` to stop taking bets after ten minutes.
 """
 
 class ChimpBotClient(commands.Bot):
+    def __init__(self, wallet, rooms, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wallet = wallet
+        self.rooms = rooms
+    
+    async def close(self):
+        await outbox.close()
+        await self.rooms.close()
+        await self.wallet.close()
+        await super().close()
     
     async def on_ready(self):
         print(f"{self.user.name} has connected!")
@@ -37,22 +55,109 @@ class ChimpBotClient(commands.Bot):
                 description=CHIMP_GREETING_BODY,
                 color=COLOUR)
             await general.send(embed=embed)
-    
-def main():
-    dotenv.load_dotenv()
 
-    token = os.getenv("DISCORD_TOKEN")
+class ShardedChimpBotClient(ChimpBotClient, commands.AutoShardedBot):
+    """
+    Runs `shard_ids` of `shard_count` shards over one gateway connection each.
+    """
+
+def build_bot(shard_ids=None, shard_count=None, process=None, processes=1):
+    """
+    Everything up to connecting: config, stores and cogs.
+
+    `process` is this process's index when the shards are split over
+    `processes` processes. Wallets are then shared through the SQLite
+    store; betting rooms belong to a channel, so each process keeps its
+    own room log for the guilds its shards serve. Each process also gets
+    its own audio cache directory with an even share of AUDIO_CACHE_SIZE.
+    """
+    dotenv.load_dotenv()
 
     intents = discord.Intents.default()
     intents.members = True
 
-    bot = ChimpBotClient(command_prefix="$", intents=intents)
-    wallet = WalletManager()
-    bot.add_cog(MusicModule(bot, wallet))
-    bot.add_cog(BettingModule(bot, wallet))
+    if os.getenv("WALLET_STORE") == "sqlite":
+        store = SqliteWalletStore(os.getenv("WALLET_DB", WALLET_DB), shared=process is not None)
+    elif process is not None:
+        raise SystemExit("Shard processes share wallets through SQLite, set WALLET_STORE=sqlite")
+    else:
+        store = TextWalletStore()
+    # shard processes don't keep the balances a ledger has to follow
+    ledger_file = os.getenv("WALLET_LEDGER", LEDGER_FILE) if process is None else None
+    wallet = WalletManager(store, Ledger(ledger_file) if ledger_file else None)
+    rooms = RoomLog(per_process(os.getenv("ROOM_LOG", ROOM_LOG), process))
+    if shard_count:
+        bot = ShardedChimpBotClient(
+            wallet, rooms, shard_ids=shard_ids, shard_count=int(shard_count), command_prefix="$", intents=intents)
+    else:
+        bot = ChimpBotClient(wallet, rooms, command_prefix="$", intents=intents)
+    # balances load in the background while the bot logs in
+    wallet.start(bot.loop)
+    audio_dir = os.getenv("AUDIO_CACHE_DIR")
+    audio_size = os.getenv("AUDIO_CACHE_SIZE")
+    if audio_dir and process is not None:
+        audio_dir = per_process(audio_dir.rstrip("/\\"), process)
+        audio_size = int(audio_size or AUDIO_CACHE_SIZE) // processes
+    bot.add_cog(MusicModule(
+        bot,
+        wallet,
+        os.getenv("EXTRACTION_CACHE_FILE"),
+        os.getenv("EXTRACTOR_MODE"),
+        os.getenv("EXTRACTOR_WORKERS"),
+        audio_dir,
+        audio_size,
+        os.getenv("PLAYBACK_MODE"),
+        os.getenv("VOICE_IDLE_TIMEOUT")))
+    bot.add_cog(BettingModule(bot, wallet, rooms))
     bot.add_cog(CommandErrHandler(bot))
     bot.add_cog(WalletModule(bot, wallet))
-    bot.run(token)
+    port = os.getenv("METRICS_PORT")
+    if port and process:
+        port = int(port) + process
+    bot.add_cog(MetricsModule(bot, port, per_process(os.getenv("METRICS_FILE"), process)))
+    return bot
+
+def per_process(path, process):
+    """
+    `rooms.journal` -> `rooms.2.journal` for shard process 2.
+    """
+    if not path or process is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{process}{ext}"
+
+def run_bot(shard_ids, shard_count, process, processes=1):
+    bot = build_bot(shard_ids, shard_count, process, processes)
+    bot.run(os.getenv("DISCORD_TOKEN"))
+
+def run_shards(processes, shard_count):
+    """
+    Start one bot process per `processes`, shard i going to process
+    i % processes, and wait for them all to exit.
+    """
+    if shard_count < processes:
+        raise SystemExit(f"SHARD_COUNT ({shard_count}) must be at least SHARD_PROCESSES ({processes})")
+    ctx = multiprocessing.get_context("spawn")
+    children = [
+        ctx.Process(
+            target=run_bot,
+            args=(list(range(i, shard_count, processes)), shard_count, i, processes),
+            name=f"chimp-shards-{i}")
+        for i in range(processes)
+    ]
+    for child in children:
+        child.start()
+    for child in children:
+        child.join()
+
+def main():
+    dotenv.load_dotenv()
+    processes = int(os.getenv("SHARD_PROCESSES") or 1)
+    shard_count = os.getenv("SHARD_COUNT")
+    if processes > 1:
+        run_shards(processes, int(shard_count or processes))
+    else:
+        run_bot(None, shard_count, None)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
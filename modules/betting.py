@@ -1,3 +1,6 @@
+import asyncio
+import re
+import time
 from os.path import exists
 import discord
 from discord.ext import commands
@@ -5,14 +8,34 @@ from discord.ext import commands
 from modules.wallet import InsufficientFundsError, NoWalletError
 from modules.errors import InvalidCommandUsage
 from modules.embed import COLOUR
+from modules.metrics import send_latency, errors
+from modules.outbox import outbox
+from modules.rooms import RoomLog, open_record, bet_record, OP_MESSAGE
+from modules.scheduler import wheel
 
 WALLET_FILE = "wallets.txt"
 
+# The live room message is edited at most this often, however fast bets come in
+LIVE_UPDATE_INTERVAL = 2.0
+
+# Rooms without a declared winner are closed and every stake refunded this
+# long after opening, unless the creator picks their own expiry
+ROOM_TTL = 24 * 60 * 60
+MAX_ROOM_TTL = 30 * 24 * 60 * 60
+# Open rooms allowed in one channel at a time
+MAX_CHANNEL_ROOMS = 10
+
+# `10m`, `2h`, `1d`, `45s`; a bare number is minutes
+DURATION = re.compile(r"^(\d+)([smhd]?)$")
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "": 60}
+
 class InvalidBet(Exception):
     def __init__(self, msg) -> None:
         self.msg = msg
 
 class Bet:
+    __slots__ = ("player", "player_name", "outcome", "amount")
+
     def __init__(self, player, player_name, outcome, amount) -> None:
         self.outcome = outcome
         self.amount = amount
@@ -20,40 +43,301 @@ class Bet:
         self.player_name = player_name
 
 class BettingRoom:
-    def __init__(self, title, outcomes, author, author_name) -> None:
+    """
+    An open bet in a channel, addressed by `id`. Bets are indexed by
+    player and bucketed by outcome with a running pool per outcome, so
+    placing a bet, reading the odds and settling never rescan every bettor.
+
+    No bets are taken from `lock_at` on (if set), and at `expires` the
+    room is closed with every stake refunded.
+    """
+    __slots__ = (
+        "outcomes", "title", "bets", "buckets", "pools", "total",
+        "author", "author_name", "created", "updated",
+        "id", "channel", "lock_at", "expires")
+
+    def __init__(
+            self, title, outcomes, author, author_name, created=None,
+            room_id=None, channel=None, lock_at=None, expires=None) -> None:
         self.outcomes = outcomes
         self.title = title
-        self.bets = []
+        self.bets = {}
+        self.buckets = {outcome: [] for outcome in outcomes}
+        self.pools = dict.fromkeys(outcomes, 0)
+        self.total = 0
         self.author = author
         self.author_name = author_name
+        self.created = created or time.time()
+        self.updated = self.created
+        self.id = room_id
+        self.channel = channel
+        self.lock_at = lock_at
+        self.expires = expires or self.created + ROOM_TTL
+
+    def locked(self, now=None):
+        return self.lock_at is not None and (now or time.time()) >= self.lock_at
     
-    def add_bet(self, bet):
+    def check_bet(self, bet):
+        """
+        Validate `bet` and resolve an outcome index to its name.
+        """
+        if self.locked():
+            raise InvalidBet("betting has closed for this room")
+
         if bet.amount <= 0:
             raise InvalidBet("bet must be greater than 0")
 
-        for b in self.bets:
-            if bet.player == b.player:
-                raise InvalidBet(f"{bet.player_name} has already placed a bet!")
+        if bet.player in self.bets:
+            raise InvalidBet(f"{bet.player_name} has already placed a bet!")
 
-        if bet.outcome not in self.outcomes:
+        if bet.outcome not in self.buckets:
             try:
                 idx = int(bet.outcome)
                 outcome = self.outcomes[idx - 1] # humans arent 0-indexed
                 bet.outcome = outcome
             except:
                 raise InvalidBet("bet must be an outcome or an index of an outcome")
-        
-        self.bets.append(bet)
+
+    def add_bet(self, bet):
+        self.check_bet(bet)
+        self.bets[bet.player] = bet
+        self.buckets[bet.outcome].append(bet)
+        self.pools[bet.outcome] += bet.amount
+        self.total += bet.amount
+        self.updated = time.time()
     
     def winners(self, outcome):
-        return list(filter(lambda b: b.outcome == outcome, self.bets))
+        return self.buckets.get(outcome, [])
+
+    def payout_ratio(self, outcome):
+        """
+        Winnings per coin staked if `outcome` wins: the fewer bettors
+        backed it, the bigger the share.
+        """
+        if not self.bets:
+            return 1
+        return 1 - len(self.buckets.get(outcome, [])) / len(self.bets)
+
+    def odds(self):
+        """
+        `(outcome, pool, bettors, payout_ratio)` for every outcome.
+        """
+        return [
+            (outcome, self.pools[outcome], len(self.buckets[outcome]), self.payout_ratio(outcome))
+            for outcome in self.outcomes
+        ]
+
+class LiveRoom:
+    """
+    The pinned message showing a room's current pools. Bets mark it
+    dirty and edits are coalesced onto a LIVE_UPDATE_INTERVAL timer, so a
+    busy room costs one edit per interval rather than one message per bet.
+    """
+    def __init__(self, room, message) -> None:
+        self.room = room
+        self.message = message
+        self.timer = None
+
+    @classmethod
+    async def open(cls, ctx, room):
+        message = await outbox.send(ctx.channel, embed=room_embed(room))
+        try:
+            await message.pin()
+        except discord.HTTPException as e:
+            print(f"Error pinning betting room: {e}")
+        return cls(room, message)
+
+    def touch(self):
+        if self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(LIVE_UPDATE_INTERVAL, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        asyncio.ensure_future(self.refresh())
+
+    async def refresh(self):
+        try:
+            with send_latency.time(op="edit"):
+                await self.message.edit(embed=room_embed(self.room))
+        except discord.HTTPException as e:
+            print(f"Error updating betting room: {e}")
+
+    async def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        await self.refresh()
+        try:
+            await self.message.unpin()
+        except discord.HTTPException as e:
+            print(f"Error unpinning betting room: {e}")
+
+def room_embed(room):
+    description = room.title
+    if room.locked():
+        description += "\nBetting has closed"
+    elif room.lock_at is not None:
+        description += f"\nBetting closes <t:{int(room.lock_at)}:R>"
+    description += f"\nRefunded <t:{int(room.expires)}:R> unless a winner is declared"
+    embed = discord.Embed(title=f"Current bet #{room.id}", description=description, color=COLOUR)
+    for idx, (outcome, pool, bettors, ratio) in enumerate(room.odds(), 1):
+        embed.add_field(
+            name=f"{idx}. {outcome}",
+            value=f"{pool} Chimp-coins from {bettors} bets\nPays {1 + ratio:.2f}x",
+            inline=True)
+    embed.set_footer(text=f"Total pool: {room.total} • Type `$bet #{room.id} <outcome> <amount>` to place a bet")
+    return embed
+
+def parse_duration(text):
+    match = DURATION.match(text)
+    if match is None:
+        raise InvalidCommandUsage(f"{text} is not a duration like `30s`, `10m`, `2h` or `1d`")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+# Rooms replayed from logs that predate room ids use their channel id as
+# their id; new ids are counted up from below this
+LEGACY_ID_FLOOR = 1 << 32
 
 class BettingModule(commands.Cog):
-    def __init__(self, bot, wallet) -> None:
+    """
+    Betting rooms, up to MAX_CHANNEL_ROOMS per channel, addressed by id.
+    Each room's lock and expiry are timers on the shared scheduler wheel,
+    so thousands of open rooms cost no polling.
+    """
+    def __init__(self, bot, wallet, rooms=None) -> None:
         self.bot = bot
         self.wallet = wallet
         super().__init__()
+        # room id -> room, and channel id -> {room id: room}
         self.curr_bets = {}
+        self.channels = {}
+        self.live = {}
+        self.timers = {}
+        # message ids of restored rooms, reattached once the bot is ready
+        self.restored = {}
+        self.next_id = 1
+        self.rooms = rooms or RoomLog()
+        self.restore()
+        self.rooms.snapshot_fn = self.snapshot
+
+    def cog_unload(self):
+        for timers in self.timers.values():
+            for timer in timers:
+                timer.cancel()
+        self.timers.clear()
+
+    def track(self, room):
+        self.curr_bets[room.id] = room
+        self.channels.setdefault(room.channel, {})[room.id] = room
+        timers = [wheel.schedule(room.expires, lambda: self.bot.loop.create_task(self.expire_room(room.id)))]
+        if room.lock_at is not None and not room.locked():
+            timers.append(wheel.schedule(room.lock_at, lambda: self.bot.loop.create_task(self.lock_room(room.id))))
+        self.timers[room.id] = timers
+
+    def untrack(self, room):
+        """
+        Close `room` to everything else before any coins move, so a
+        winner and an expiry can't both pay it out.
+        """
+        del self.curr_bets[room.id]
+        rooms = self.channels[room.channel]
+        del rooms[room.id]
+        if not rooms:
+            del self.channels[room.channel]
+        for timer in self.timers.pop(room.id, ()):
+            timer.cancel()
+        self.restored.pop(room.id, None)
+        self.rooms.close_room(room.id)
+
+    def restore(self):
+        for room_id, (opened, message_id, bets) in self.rooms.replay().items():
+            (_, _, channel, title, outcomes, author, author_name, created, lock_at, expires) = opened
+            room = BettingRoom(title, outcomes, author, author_name, created, room_id, channel)
+            for (_, _, player, player_name, outcome, amount, _) in bets:
+                room.add_bet(Bet(player, player_name, outcome, amount))
+            room.updated = max([created] + [b[6] for b in bets])
+            # set once the bets are back in, they were taken before the lock
+            room.lock_at = lock_at
+            # rooms from before expiries were reaped ROOM_TTL after their last bet
+            room.expires = expires or room.updated + ROOM_TTL
+            self.track(room)
+            if message_id is not None:
+                self.restored[room_id] = message_id
+        self.next_id = max((room_id for room_id in self.curr_bets if room_id < LEGACY_ID_FLOOR), default=0) + 1
+
+    def snapshot(self):
+        out = []
+        for room_id, room in self.curr_bets.items():
+            out.append(open_record(room))
+            live = self.live.get(room_id)
+            message_id = live.message.id if live is not None else self.restored.get(room_id)
+            if message_id is not None:
+                out.append([OP_MESSAGE, room_id, message_id])
+            out.extend(bet_record(room_id, bet, room.updated) for bet in room.bets.values())
+        return out
+
+    def pick(self, channel_id, msg):
+        """
+        Split an optional leading `#<id>` off `msg` and find the room it
+        names, else the channel's only room (None if it has none).
+        """
+        rooms = self.channels.get(channel_id, {})
+        if msg.startswith("#"):
+            (token, _, msg) = msg.partition(" ")
+            room = rooms.get(int(token[1:])) if token[1:].isdigit() else None
+            if room is None:
+                raise InvalidCommandUsage(f"There is no betting room {token} in this channel")
+            return (room, msg.strip())
+        if len(rooms) > 1:
+            ids = ", ".join(f"#{room_id}" for room_id in rooms)
+            raise InvalidCommandUsage(f"This channel has several betting rooms, start with one of {ids}")
+        return (next(iter(rooms.values()), None), msg)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for room_id, message_id in list(self.restored.items()):
+            del self.restored[room_id]
+            room = self.curr_bets.get(room_id)
+            channel = self.bot.get_channel(room.channel) if room is not None else None
+            if channel is None:
+                continue
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.HTTPException as e:
+                print(f"Error restoring betting room message: {e}")
+                continue
+            self.live[room_id] = LiveRoom(room, message)
+            self.live[room_id].touch()
+
+    async def lock_room(self, room_id):
+        room = self.curr_bets.get(room_id)
+        if room is None:
+            return
+        live = self.live.get(room_id)
+        if live is not None:
+            await live.refresh()
+        channel = self.bot.get_channel(room.channel)
+        if channel is not None:
+            embed = discord.Embed(title=f"Betting has closed for #{room_id}", description=room.title, color=COLOUR)
+            embed.set_footer(text=f"Type `$bet-winner #{room_id} <outcome>` to pay out the winners")
+            outbox.post(channel, embed=embed)
+
+    async def expire_room(self, room_id):
+        room = self.curr_bets.get(room_id)
+        if room is None:
+            return
+        self.untrack(room)
+        await self.wallet.settle([(bet.player, bet.amount) for bet in room.bets.values()], "refund")
+        live = self.live.pop(room_id, None)
+        if live is not None:
+            await live.close()
+
+        channel = self.bot.get_channel(room.channel)
+        if channel is not None:
+            embed = discord.Embed(title=f"Betting room #{room_id} closed", description=room.title, color=COLOUR)
+            embed.set_footer(text=f"No winner was declared, so {len(room.bets)} bets were refunded")
+            outbox.post(channel, embed=embed)
     
     @staticmethod
     def load_wallets():
@@ -70,88 +354,128 @@ class BettingModule(commands.Cog):
     
     @commands.command(name="bet")
     async def bet(self, ctx, *, msg):
+        if " - " in msg or ctx.channel.id not in self.channels:
+            await self.open_room(ctx, msg)
+        else:
+            await self.place_bet(ctx, msg)
+
+    async def open_room(self, ctx, msg):
         channel_id = ctx.channel.id
         player = ctx.author.id
         player_name = ctx.author.name
-        if channel_id not in self.curr_bets:
-            # <msg> - <op> or <op>
-            try:
-                [title, opts] = msg.split(" - ")
-                opts = opts.split(" or ")
-            except:
-                raise InvalidCommandUsage("New bet command must be in form `<outcome> - <op> or <op>`")
-            
-            self.curr_bets[channel_id] = BettingRoom(title, opts, player, player_name)
-            embed = discord.Embed(title="A new betting room is open!", color=COLOUR)
-            embed.set_footer(text="Type `$bet <outcome> <amount>` to place a bet")
-            await ctx.send(embed=embed)
-        else:
-            # bet on existing bet
-            # <outcome> <amount>
-            try:
-                [outcome, str_amt] = msg.split(" ")
-            except:
-                raise InvalidCommandUsage("Bet command must be in form `<outcome> <amount>`")
+        # <msg> - <op> or <op> [| <bets close in> [<refund in>]]
+        (spec, _, timing) = msg.partition(" | ")
+        try:
+            [title, opts] = spec.split(" - ")
+            opts = opts.split(" or ")
+        except:
+            raise InvalidCommandUsage(
+                "New bet command must be in form `<outcome> - <op> or <op>`, "
+                "optionally followed by ` | <bets close in> <refund in>` (Ex: `| 10m 2h`)")
+        durations = [parse_duration(token) for token in timing.split()]
+        if len(durations) > 2:
+            raise InvalidCommandUsage("A betting room takes at most two durations: when bets close and when it expires")
+        if len(self.channels.get(channel_id, ())) >= MAX_CHANNEL_ROOMS:
+            raise InvalidCommandUsage(f"A channel can have at most {MAX_CHANNEL_ROOMS} betting rooms open")
 
-            try:
-                amt = int(str_amt)     
-            except:
-                raise InvalidCommandUsage("Bet amount required and must be integer")
+        now = time.time()
+        lock_at = now + durations[0] if durations else None
+        expires = now + min(durations[1] if len(durations) > 1 else ROOM_TTL, MAX_ROOM_TTL)
+        if lock_at is not None and lock_at > expires:
+            raise InvalidCommandUsage("Betting has to close before the room expires")
 
+        room = BettingRoom(title, opts, player, player_name, now, self.next_id, channel_id, lock_at, expires)
+        self.next_id += 1
+        self.track(room)
+        self.rooms.open_room(room)
+        embed = discord.Embed(title=f"A new betting room #{room.id} is open!", color=COLOUR)
+        embed.set_footer(text="Odds are kept up to date in the pinned message")
+        outbox.post(ctx.channel, embed=embed)
+        live = await LiveRoom.open(ctx, room)
+        self.live[room.id] = live
+        self.rooms.set_message(room.id, live.message.id)
+
+    async def place_bet(self, ctx, msg):
+        channel_id = ctx.channel.id
+        player = ctx.author.id
+        player_name = ctx.author.name
+        (room, msg) = self.pick(channel_id, msg)
+        # [#id] <outcome> <amount>
+        try:
+            [outcome, str_amt] = msg.split(" ")
+        except:
+            raise InvalidCommandUsage("Bet command must be in form `[#room] <outcome> <amount>`")
+
+        try:
+            amt = int(str_amt)     
+        except:
+            raise InvalidCommandUsage("Bet amount required and must be integer")
+
+        try:
+            bet = Bet(player, player_name, outcome, amt)
+            room.check_bet(bet)
+            await self.wallet.withdraw(player, amt, "stake")
             try:
-                bet = Bet(player, player_name, outcome, amt)
-                self.wallet.withdraw(player, amt)
-                self.curr_bets[channel_id].add_bet(bet)
-                embed = discord.Embed(
-                    title=f"Bet placed by {player_name}",
-                    description=f"{bet.outcome} for {bet.amount}",
-                    color=COLOUR)
-                await ctx.send(embed=embed)
-            except InvalidBet as e:
-                embed = discord.Embed(title="Invalid bet", description=e, color=COLOUR)
-                await ctx.send(embed=embed)
-                return
-            except NoWalletError:
-                embed = discord.Embed(
-                    title="Cannot place bet",
-                    description=f"{player_name} does not have a Chimp-wallet yet!",
-                    color=COLOUR)
-                embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
-                await ctx.send(embed=embed)
-                return
-            except InsufficientFundsError:
-                embed = discord.Embed(title=f"Cannot accept bet from {player_name} - you do not have that much Chimp-coin", color=COLOUR)
-                embed.set_footer(text="Type `$balance` to see how much you have")
-                await ctx.send(embed=embed)
-                return
-            except Exception as e:
-                embed = discord.Embed(title="Unexpected error taking bet", color=COLOUR)
-                print(f"Error processing bet: {e}")
-                await ctx.send(embed=embed)
-                return
+                # the room may have closed, or this player bet twice, while we withdrew
+                if self.curr_bets.get(room.id) is not room:
+                    raise InvalidBet("the betting room closed before the bet was placed")
+                room.add_bet(bet)
+            except InvalidBet:
+                await self.wallet.deposit(player, amt, "refund")
+                raise
+            self.rooms.add_bet(room.id, bet, room.updated)
+            live = self.live.get(room.id)
+            if live is not None:
+                live.touch()
+        except InvalidBet as e:
+            embed = discord.Embed(title="Invalid bet", description=str(e), color=COLOUR)
+            outbox.post(ctx.channel, embed=embed, merge=True)
+            return
+        except NoWalletError:
+            embed = discord.Embed(
+                title="Cannot place bet",
+                description=f"{player_name} does not have a Chimp-wallet yet!",
+                color=COLOUR)
+            embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
+            outbox.post(ctx.channel, embed=embed)
+            return
+        except InsufficientFundsError:
+            embed = discord.Embed(title=f"Cannot accept bet from {player_name} - you do not have that much Chimp-coin", color=COLOUR)
+            embed.set_footer(text="Type `$balance` to see how much you have")
+            outbox.post(ctx.channel, embed=embed)
+            return
+        except Exception as e:
+            embed = discord.Embed(title="Unexpected error taking bet", color=COLOUR)
+            errors.inc(where="bet")
+            print(f"Error processing bet: {e}")
+            outbox.post(ctx.channel, embed=embed)
+            return
     
     @commands.command(name="bet-running")
-    async def bet_running(self, ctx):
-        channel_id = ctx.channel.id
-        if channel_id not in self.curr_bets:
+    async def bet_running(self, ctx, *, msg=""):
+        rooms = self.channels.get(ctx.channel.id, {})
+        if not rooms:
             embed = discord.Embed(title="No betting room is currently running", color=COLOUR)
             embed.set_footer(text="Type `$bet <msg> - <op> or <op>` to start a new bet")
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
+        elif len(rooms) == 1 or msg:
+            (room, _) = self.pick(ctx.channel.id, msg)
+            outbox.post(ctx.channel, embed=room_embed(room), key=("room", room.id))
         else:
-            curr = self.curr_bets[channel_id].title
-            ops = self.curr_bets[channel_id].outcomes
-            embed = discord.Embed(title="Current bet", description=curr, color=COLOUR)
-            embed.set_footer(text=f"Bet options: {ops}")
-            await ctx.send(embed=embed)
+            lines = "".join(
+                f"#{room.id} {room.title} ({room.total} Chimp-coins{', closed to bets' if room.locked() else ''})\n"
+                for room in rooms.values())
+            embed = discord.Embed(title="Betting rooms in this channel", description=lines, color=COLOUR)
+            embed.set_footer(text="Type `$bet-running #<room>` for its odds")
+            outbox.post(ctx.channel, embed=embed, key="rooms")
     
     @commands.command(name="bet-winner")
     async def bet_winner(self, ctx, *, msg):
         author = ctx.author.id
-        channel_id = ctx.channel.id
-        if channel_id not in self.curr_bets:
+        (room, msg) = self.pick(ctx.channel.id, msg)
+        if room is None:
             raise InvalidCommandUsage("A betting room must be open to declare a winner")
         
-        room = self.curr_bets[channel_id]
         if room.author != author:
             raise InvalidCommandUsage(f"Only the room creator {room.author_name} can declare a winner")
         
@@ -163,27 +487,17 @@ class BettingModule(commands.Cog):
             except:
                 raise InvalidCommandUsage("Winning outcome must be one of the possible outcomes")
         
-        total_bets = len(room.bets)
         winners = room.winners(winning_outcome)
-        total_winners = len(winners)
-        ratio = 1
-        if total_bets != 0:
-            ratio -= total_winners / total_bets
+        ratio = room.payout_ratio(winning_outcome)
         
-        winners_list = ""
-        for win in winners:
-            amt = win.amount + win.amount * ratio
-            amt = int(round(amt))
-            self.wallet.deposit(win.player, amt)
-            winners_list += f"• {win.player_name} ({amt})\n"
+        payouts = [(win, int(round(win.amount + win.amount * ratio))) for win in winners]
+        self.untrack(room)
+        await self.wallet.settle([(win.player, amt) for win, amt in payouts])
         
         embed = discord.Embed(title=f"{winning_outcome} wins!")
-        embed.add_field(name="Winners", value=winners_list)
+        embed.add_field(name="Winners", value="".join(f"• {win.player_name} ({amt})\n" for win, amt in payouts))
 
-        del self.curr_bets[channel_id]
-        await ctx.send(embed=embed)
-    
-    @bet.after_invoke
-    @bet_winner.after_invoke
-    async def persist_wallets(self, ctx):
-        await self.wallet.persist()
\ No newline at end of file
+        live = self.live.pop(room.id, None)
+        if live is not None:
+            await live.close()
+        outbox.post(ctx.channel, embed=embed)
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from os.path import exists
+from urllib.parse import urlparse, parse_qs
+
+# query -> video key mappings rarely change, resolved stream info does
+QUERY_TTL = 24 * 60 * 60
+INFO_TTL = 60 * 60
+# Stop serving a signed stream URL this long before it expires
+EXPIRY_MARGIN = 120
+
+# On-disk audio: total size cap, and how many plays earn a track a local copy
+AUDIO_CACHE_SIZE = 2 << 30
+AUDIO_PROMOTE_AFTER = 2
+# Play counts are kept for this many tracks not yet on disk, and only
+# plays within PLAY_WINDOW seconds of each other add up
+PLAY_COUNTS = 10000
+PLAY_WINDOW = 7 * 24 * 60 * 60
+AUDIO_EXT = ".opus"
+PINS_FILE = "pins.json"
+# Pinned files may fill at most this share of the cache; past it the least
+# recently played pins are unpinned and evicted like any other file
+PINNED_SHARE = 0.5
+
+class TTLCache:
+    """
+    Bounded mapping with per-entry expiry and least-recently-used eviction.
+    """
+    def __init__(self, maxsize) -> None:
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        (expires, value) = entry
+        if expires <= time.time():
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl):
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class ExtractionCache:
+    """
+    Caches youtube_dl results in two levels: the query (search text or URL)
+    to a video's webpage_url, and the webpage_url to its stream info.
+    Stream info expires with its signed URL.
+    """
+    def __init__(self, maxsize=2048, path=None) -> None:
+        self.queries = TTLCache(maxsize * 4)
+        self.infos = TTLCache(maxsize)
+        self.path = path
+
+    def get(self, query):
+        key = self.queries.get(query) or query
+        return self.infos.get(key)
+
+    def put(self, query, info):
+        key = info.get('webpage_url') or info.get('id') or query
+        self.queries.put(query, key, QUERY_TTL)
+        self.queries.put(key, key, QUERY_TTL)
+        ttl = stream_ttl(info)
+        if ttl > 0:
+            self.infos.put(key, info, ttl)
+
+    def stats(self):
+        return {
+            "entries": len(self.infos),
+            "hits": self.infos.hits,
+            "misses": self.infos.misses,
+        }
+
+    def load(self, path=None):
+        self.restore(path, self.read(path))
+
+    def read(self, path=None):
+        """
+        Parse the saved cache file without touching the live cache,
+        so it can run on a worker thread.
+        """
+        path = path or self.path
+        if path is None or not exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading extraction cache: {e}")
+            return {}
+
+    def restore(self, path, saved):
+        # only save back to a file once its contents have been merged in
+        self.path = path or self.path
+        now = time.time()
+        for name in ("queries", "infos"):
+            cache = getattr(self, name)
+            for key, expires, value in saved.get(name, []):
+                if expires > now:
+                    cache.put(key, value, expires - now)
+
+    def save(self):
+        if self.path is None:
+            return
+        out = {
+            name: [(key, expires, value) for key, (expires, value) in getattr(self, name).entries.items()]
+            for name in ("queries", "infos")
+        }
+        # shard processes may share the file, so don't share the temp file too
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(out, f)
+        os.replace(tmp, self.path)
+
+class AudioCache:
+    """
+    Size-bounded directory of downloaded tracks, keyed by webpage_url.
+    A track is worth downloading once it has been played
+    AUDIO_PROMOTE_AFTER times within PLAY_WINDOW or is pinned; after that
+    it is played from disk. The least recently played unpinned files are evicted to stay
+    under `max_bytes`; pins count towards it too, and are only kept while
+    they fit in PINNED_SHARE of it. Disabled until `load` is given a
+    directory.
+    """
+    def __init__(self, directory=None, max_bytes=AUDIO_CACHE_SIZE, promote_after=AUDIO_PROMOTE_AFTER) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.promote_after = promote_after
+        self.files = OrderedDict()
+        self.size = 0
+        self.plays = TTLCache(PLAY_COUNTS)
+        self.pinned = set()
+        self.pending = set()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, directory=None, max_bytes=None):
+        self.directory = directory or self.directory
+        self.max_bytes = int(max_bytes or self.max_bytes)
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(AUDIO_EXT):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            found.append((st.st_mtime, name[:-len(AUDIO_EXT)], st.st_size))
+        # mtime is bumped on every hit, so oldest first is least recently played
+        for _, digest, size in sorted(found):
+            self.files[digest] = size
+            self.size += size
+
+        pins = os.path.join(self.directory, PINS_FILE)
+        if exists(pins):
+            try:
+                with open(pins) as f:
+                    self.pinned = set(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Error loading pinned tracks: {e}")
+        self.evict()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def stem(self, key):
+        """
+        Path for `key` without its extension.
+        """
+        return os.path.join(self.directory, _digest(key))
+
+    def get(self, key):
+        if not self.enabled or not key:
+            return None
+        digest = _digest(key)
+        if digest not in self.files:
+            self.misses += 1
+            return None
+        path = self.stem(key) + AUDIO_EXT
+        try:
+            os.utime(path)
+        except OSError:
+            self._drop(digest)
+            self.misses += 1
+            return None
+        self.files.move_to_end(digest)
+        self.hits += 1
+        return path
+
+    def wants(self, key):
+        """
+        Count a play of `key` and say whether it should be downloaded now.
+        """
+        if not self.enabled or not key:
+            return False
+        digest = _digest(key)
+        if digest in self.files or digest in self.pending:
+            return False
+        plays = (self.plays.get(digest) or 0) + 1
+        if plays >= self.promote_after or digest in self.pinned:
+            # on its way to disk, where plays no longer need counting
+            self.plays.entries.pop(digest, None)
+            return True
+        self.plays.put(digest, plays, PLAY_WINDOW)
+        return False
+
+    def pin(self, key):
+        self.pinned.add(_digest(key))
+        self._save_pins()
+
+    def unpin(self, key):
+        """
+        Whether `key` was pinned. Its file stays until it is evicted.
+        """
+        digest = _digest(key)
+        if digest not in self.pinned:
+            return False
+        self.pinned.discard(digest)
+        self._save_pins()
+        return True
+
+    async def fill(self, key, download):
+        """
+        Run `download(key, stem)`, which returns the finished file's path,
+        and adopt the file into the cache.
+        """
+        digest = _digest(key)
+        self.pending.add(digest)
+        try:
+            path = await download(key, self.stem(key))
+            size = os.path.getsize(path)
+            if digest in self.files:
+                self.size -= self.files[digest]
+            self.files[digest] = size
+            self.size += size
+            self.evict()
+        finally:
+            self.pending.discard(digest)
+
+    def evict(self):
+        pinned_cap = self.max_bytes * PINNED_SHARE
+        pinned_size = sum(size for digest, size in self.files.items() if digest in self.pinned)
+        unpinned = False
+        for digest in list(self.files):
+            if self.size <= self.max_bytes and pinned_size <= pinned_cap:
+                break
+            if digest in self.pinned:
+                if pinned_size <= pinned_cap:
+                    continue
+                self.pinned.discard(digest)
+                pinned_size -= self.files[digest]
+                unpinned = True
+            elif self.size <= self.max_bytes:
+                continue
+            self._drop(digest)
+            try:
+                os.remove(os.path.join(self.directory, digest + AUDIO_EXT))
+            except OSError:
+                pass
+        if unpinned:
+            self._save_pins()
+
+    def _drop(self, digest):
+        self.size -= self.files.pop(digest, 0)
+
+    def _save_pins(self):
+        if not self.enabled:
+            return
+        with open(os.path.join(self.directory, PINS_FILE), "w") as f:
+            json.dump(sorted(self.pinned), f)
+
+    def stats(self):
+        return {
+            "entries": len(self.files),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+def _digest(key):
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def stream_ttl(info):
+    """
+    Seconds the stream URL in `info` can still be handed to FFmpeg.
+    Signed URLs carry their expiry as an `expire` query parameter; leave
+    enough headroom to play the whole track before it lapses.
+    """
+    url = info.get('url') or ""
+    expire = parse_qs(urlparse(url).query).get('expire')
+    if not expire:
+        return INFO_TTL
+
+    try:
+        remaining = int(expire[0]) - time.time()
+    except ValueError:
+        return INFO_TTL
+    return min(INFO_TTL, remaining - (info.get('duration') or 0) - EXPIRY_MARGIN)
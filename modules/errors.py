@@ -4,6 +4,8 @@ import traceback
 from discord.ext import commands
 
 from modules.embed import COLOUR
+from modules.metrics import errors
+from modules.outbox import outbox
 
 class InvalidCommandUsage(Exception):
     def __init__(self, usage):
@@ -24,11 +26,12 @@ class CommandErrHandler(commands.Cog):
         error: commands.CommandError
             The Exception raised.
         """
+        errors.inc(where="command", kind=type(getattr(error, "original", error)).__name__)
         if isinstance(error, commands.CommandNotFound):
-            await ctx.send('I do not know that command?!')
+            outbox.post(ctx.channel, 'I do not know that command?!')
         elif isinstance(error, commands.CommandInvokeError) and isinstance(error.original, InvalidCommandUsage):
             embed = discord.Embed(title=f"Invalid command usage: {error.original.usage}", colour=COLOUR)
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
         else:
             print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
             traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
\ No newline at end of file
@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from modules.metrics import extract_latency, extract_wait, errors
+
+# Worker count for the extraction pool, and how many extractions one guild
+# may have in flight at a time
+EXTRACT_WORKERS = 4
+GUILD_CONCURRENCY = 2
+# Seconds a single youtube_dl call may take before the caller gives up on it
+EXTRACT_TIMEOUT = 30
+# Playlists are read this many flat entries per pool call
+PLAYLIST_PAGE = 50
+# Background downloads for the audio cache share the pool, so keep them few
+DOWNLOAD_CONCURRENCY = 1
+DOWNLOAD_TIMEOUT = 600
+
+ytdl_format_options = {
+    'filter': 'audioonly',
+    'highWaterMark': 1<<25,
+    # Opus in webm can be passed straight through to Discord, see YTDLOpusSource
+    'format': 'bestaudio[acodec=opus]/bestaudio',
+    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',  # bind to ipv4 since ipv6 addresses cause issues sometimes
+}
+
+_local = threading.local()
+
+def load_youtube_dl():
+    """
+    Import youtube_dl on first use; it is slow to import and only the
+    music commands need it.
+    """
+    import youtube_dl
+    # Suppress noise about console usage from errors
+    youtube_dl.utils.bug_reports_message = lambda: ''
+    return youtube_dl
+
+def prepare_filename(data):
+    """
+    Where youtube_dl put a downloaded (non-streamed) track.
+    """
+    ytdl = getattr(_local, "ytdl", None)
+    if ytdl is None:
+        ytdl = _local.ytdl = load_youtube_dl().YoutubeDL(ytdl_format_options)
+    return ytdl.prepare_filename(data)
+
+def extract_info(url, download):
+    """
+    Runs inside a pool worker. Each worker thread (or process) keeps its
+    own YoutubeDL instance, since one instance isn't safe to share.
+    """
+    ytdl = getattr(_local, "ytdl", None)
+    if ytdl is None:
+        ytdl = _local.ytdl = load_youtube_dl().YoutubeDL(ytdl_format_options)
+    data = ytdl.extract_info(url, download=download)
+    if 'entries' in data:
+        # take first item from a playlist, before it has to cross back to the bot
+        data = data['entries'][0]
+    return data
+
+def extract_playlist_page(url, start, end):
+    """
+    Runs inside a pool worker. Flat-extracts entries `start`..`end`
+    (1-based, inclusive) of a playlist as a list of playable URLs,
+    without resolving any of them.
+    """
+    options = dict(
+        ytdl_format_options,
+        noplaylist=False,
+        extract_flat='in_playlist',
+        playliststart=start,
+        playlistend=end,
+    )
+    with load_youtube_dl().YoutubeDL(options) as ytdl:
+        data = ytdl.extract_info(url, download=False)
+    out = []
+    for entry in data.get('entries') or []:
+        entry_url = entry.get('webpage_url') or entry.get('url')
+        if entry.get('ie_key') == 'Youtube' and not entry_url.startswith("http"):
+            entry_url = f"https://www.youtube.com/watch?v={entry_url}"
+        if entry_url:
+            out.append(entry_url)
+    return out
+
+def is_playlist(query):
+    """
+    True for playlist URLs. A video link that carries a `list=` parameter
+    still counts as the single video, as it did with `noplaylist`.
+    """
+    url = urlparse(query)
+    if url.scheme not in ("http", "https"):
+        return False
+    params = parse_qs(url.query)
+    # youtu.be links carry the video id in the path instead of `v=`
+    video = 'v' in params or (url.hostname == "youtu.be" and url.path.strip("/") != "")
+    return url.path.rstrip("/").endswith("/playlist") or ('list' in params and not video)
+
+def download_audio(url, stem):
+    """
+    Runs inside a pool worker. Downloads `url` and has FFmpeg extract it
+    to `<stem>.opus`, returning that path.
+    """
+    options = dict(
+        ytdl_format_options,
+        outtmpl=stem + ".%(ext)s",
+        postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}],
+    )
+    with load_youtube_dl().YoutubeDL(options) as ytdl:
+        ytdl.extract_info(url, download=True)
+    return stem + ".opus"
+
+def _release(loop, sem):
+    # runs on whichever thread finished or cancelled the call
+    try:
+        loop.call_soon_threadsafe(sem.release)
+    except RuntimeError:
+        # the loop has closed, nobody is left waiting on the slot
+        pass
+
+class Extractor:
+    """
+    Dedicated pool for youtube_dl calls, so a burst of `$play` commands
+    can't fill the loop's default executor. `mode` is "thread" or
+    "process"; a process pool keeps youtube_dl's parsing off the bot's GIL.
+
+    Each guild gets at most GUILD_CONCURRENCY calls at once and every wait
+    is bounded by EXTRACT_TIMEOUT. A call keeps its guild's slot until its
+    worker is actually done with it, so a guild whose calls hang past the
+    timeout stalls only itself rather than filling the pool. Cancelling
+    the awaiting task drops a call that hasn't reached a worker yet.
+    """
+    def __init__(self, mode="thread", workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT) -> None:
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None
+        self.guilds = {}
+        self.downloads = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+    def start(self, mode=None, workers=None):
+        self.mode = mode or self.mode
+        self.workers = int(workers or self.workers)
+        if self.executor is not None:
+            return
+        if self.mode == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ytdl")
+
+    def _limit(self, guild_id):
+        sem = self.guilds.get(guild_id)
+        if sem is None:
+            sem = self.guilds[guild_id] = asyncio.Semaphore(GUILD_CONCURRENCY)
+        return sem
+
+    async def _call(self, sem, loop, fn, *args):
+        """
+        Take a slot of `sem` and run `fn(*args)` on the pool. The slot is
+        handed back when the worker finishes, or when the call is
+        cancelled before it starts, not when the caller stops waiting.
+        """
+        await sem.acquire()
+        try:
+            call = self.executor.submit(fn, *args)
+        except BaseException:
+            sem.release()
+            raise
+        call.add_done_callback(lambda _: _release(loop, sem))
+        return asyncio.wrap_future(call, loop=loop)
+
+    async def extract(self, url, *, download=False, guild_id=None, loop=None):
+        self.start()
+        loop = loop or asyncio.get_event_loop()
+        queued = time.perf_counter()
+        future = await self._call(self._limit(guild_id), loop, extract_info, url, download)
+        start = time.perf_counter()
+        extract_wait.observe(start - queued)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            errors.inc(where="extract_timeout")
+            raise
+        finally:
+            extract_latency.observe(time.perf_counter() - start)
+
+    async def playlist_page(self, url, start, *, guild_id=None, loop=None):
+        self.start()
+        loop = loop or asyncio.get_event_loop()
+        future = await self._call(
+            self._limit(guild_id), loop, extract_playlist_page, url, start, start + PLAYLIST_PAGE - 1)
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def download(self, url, stem, *, loop=None):
+        self.start()
+        loop = loop or asyncio.get_event_loop()
+        future = await self._call(self.downloads, loop, download_audio, url, stem)
+        return await asyncio.wait_for(future, DOWNLOAD_TIMEOUT)
+
+    def forget(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,225 @@
+import asyncio
+import os
+from os.path import exists
+
+from modules.metrics import persist_latency
+
+SNAPSHOT_FILE = "wallets.txt"
+JOURNAL_FILE = "wallets.journal"
+
+# Group commit: pending records are flushed and fsynced at most this often,
+# or straight away once this many are waiting.
+COMMIT_INTERVAL = 1.0
+COMMIT_BATCH = 256
+
+# Fold the journal into a fresh snapshot after this many records.
+COMPACT_THRESHOLD = 10000
+
+OP_NEW = "n"
+OP_WITHDRAW = "w"
+OP_DEPOSIT = "d"
+
+class GroupCommit():
+    """
+    The append side shared by the wallet journal, the room log and the
+    ledger. Records wait in `pending` until the owner's `commit_fn` runs,
+    at most COMMIT_INTERVAL after the first one arrives or straight away
+    once COMMIT_BATCH are waiting. `commit_fn` holds `lock` while it
+    writes, so commits never interleave, and hands its data to `append`
+    on a worker thread.
+    """
+    def __init__(self, path, commit_fn, binary=False):
+        self.path = path
+        self.commit_fn = commit_fn
+        self.binary = binary
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.file = None
+        self.end = None
+
+    def add(self, record):
+        self.pending.append(record)
+        self.schedule()
+
+    def schedule(self):
+        if len(self.pending) >= COMMIT_BATCH:
+            self._schedule(0)
+        else:
+            self._schedule(COMMIT_INTERVAL)
+
+    def _schedule(self, delay):
+        if self.timer is not None:
+            if delay > 0:
+                return
+            self.timer.cancel()
+        loop = asyncio.get_event_loop()
+        self.timer = loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        asyncio.ensure_future(self.commit_fn())
+
+    def append(self, data):
+        if self.file is None:
+            if self.end is not None and exists(self.path) and os.path.getsize(self.path) > self.end:
+                with open(self.path, "r+b") as f:
+                    f.truncate(self.end)
+            self.end = None
+            self.file = open(self.path, "ab" if self.binary else "a")
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def trim(self, end):
+        """
+        Note that the last complete record ends `end` bytes in. Anything
+        after it was torn by a crash, and is cut off before the first
+        append so the next record isn't glued onto it. Replaying alone
+        leaves the file untouched.
+        """
+        self.end = end
+
+    def replace(self, data):
+        """
+        Swap in a file holding just `data`, written whole before it
+        replaces the current one; later appends go after it.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb" if self.binary else "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.close_file()
+        os.replace(tmp, self.path)
+        # the torn tail noted at replay went with the old file
+        self.end = None
+
+    def truncate(self):
+        """
+        Empty the file; later appends start from the top.
+        """
+        self.close_file()
+        self.end = None
+        self.file = open(self.path, "wb" if self.binary else "w")
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class WalletJournal():
+    """
+    Append-only transaction log for wallet balances.
+
+    Every transaction becomes one line in the journal,
+    `<seq> <op> <player> <amt> [<op> <player> <amt> ...]`, so a batch of
+    withdraw/deposit/new_wallet ops replays all-or-nothing. Lines are buffered and group-committed
+    on a short timer, so a crash loses at most one commit window.
+    Every so often the journal is compacted into a snapshot
+    (the `player=bal` file) headed by the last sequence number it covers.
+    """
+    def __init__(self, snapshot_fn, snapshot_file=SNAPSHOT_FILE, journal_file=JOURNAL_FILE):
+        self.snapshot_fn = snapshot_fn
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.seq = 0
+        self.since_compact = 0
+        self.log = GroupCommit(journal_file, self.commit)
+
+    def replay(self):
+        """
+        Rebuild balances from the snapshot plus any newer journal records.
+        A torn trailing record from a crash mid-write is cut off.
+        """
+        balances = {}
+        snap_seq = 0
+        if exists(self.snapshot_file):
+            with open(self.snapshot_file) as f:
+                for entry in f:
+                    if entry.startswith("#seq="):
+                        snap_seq = int(entry[5:])
+                        continue
+                    [player, bal] = entry.split("=")
+                    balances[int(player)] = int(bal)
+
+        self.seq = snap_seq
+        if exists(self.journal_file):
+            end = 0
+            with open(self.journal_file, "rb") as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    try:
+                        parts = raw.decode().split()
+                        seq = int(parts[0])
+                        ops = [(parts[i], int(parts[i + 1]), int(parts[i + 2])) for i in range(1, len(parts), 3)]
+                    except (ValueError, IndexError):
+                        break
+                    end += len(raw)
+                    if seq <= snap_seq:
+                        continue
+                    for op, player, amt in ops:
+                        apply(balances, op, player, amt)
+                    self.seq = seq
+                    self.since_compact += 1
+            self.log.trim(end)
+        return balances
+
+    def record(self, ops):
+        self.seq += 1
+        body = " ".join(f"{op} {player} {amt}" for op, player, amt in ops)
+        self.log.add(f"{self.seq} {body}\n")
+
+    async def commit(self, compact=False):
+        async with self.log.lock:
+            records = self.log.pending
+            self.log.pending = []
+            self.since_compact += len(records)
+            snapshot = None
+            if compact or self.since_compact >= COMPACT_THRESHOLD:
+                # taken in the same tick as `records`, so it covers exactly up to self.seq
+                snapshot = self.snapshot_fn()
+                self.since_compact = 0
+            if not records and snapshot is None:
+                return
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._write, records, snapshot, self.seq)
+
+    def _write(self, records, snapshot, seq):
+        with persist_latency.time(store="journal"):
+            self._write_records(records, snapshot, seq)
+
+    def _write_records(self, records, snapshot, seq):
+        if records:
+            self.log.append("".join(records))
+
+        if snapshot is not None:
+            tmp = self.snapshot_file + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(f"#seq={seq}\n")
+                f.write("".join(f"{player}={bal}\n" for player, bal in snapshot.items()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_file)
+            # records up to seq are now in the snapshot; replay skips them even
+            # if we crash before the truncate lands
+            self.log.truncate()
+
+    async def close(self):
+        self.log.stop()
+        await self.commit(compact=True)
+        self.log.close_file()
+
+def apply(balances, op, player, amt):
+    if op == OP_NEW:
+        balances[player] = amt
+    elif op == OP_WITHDRAW:
+        balances[player] -= amt
+    elif op == OP_DEPOSIT:
+        balances[player] += amt
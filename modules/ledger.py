@@ -0,0 +1,182 @@
+import asyncio
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from os.path import exists
+
+from modules.metrics import persist_latency
+from modules.journal import WalletJournal, GroupCommit
+
+LEDGER_FILE = "wallets.ledger"
+
+# <txn> <unix seconds> <player> <change> <balance after> <reason>, 33 bytes
+RECORD = struct.Struct("<IIQqqB")
+# Records read per chunk when indexing the file at startup
+READ_CHUNK = 4096
+
+# Why a balance changed; the index into this list is what gets stored
+REASONS = ["other", "opening", "welcome", "stake", "payout", "refund", "premium"]
+REASON_CODES = {name: code for code, name in enumerate(REASONS)}
+
+class Ledger():
+    """
+    Append-only record of every balance change, one fixed-size binary
+    record per player per transaction. Records of one transaction share
+    a `txn` number.
+
+    `index` maps each player to an array of their record numbers, so a
+    page of `history` is a handful of positioned reads however long the
+    file grows. Records are group-committed like the wallet journal's;
+    ones not yet on disk are served from the commit's `pending` list.
+    """
+    def __init__(self, path=LEDGER_FILE):
+        self.path = path
+        self.index = {}
+        self.written = 0
+        self.txn = 0
+        self.log = GroupCommit(path, self.commit, binary=True)
+
+    def load(self, balances):
+        """
+        Index the file. Runs on a worker thread during startup. A new
+        ledger opens with one record per existing wallet, so the audit
+        has a starting balance for everyone.
+        """
+        count = 0
+        if exists(self.path):
+            size = os.path.getsize(self.path)
+            # a torn trailing record from a crash mid-write is skipped, then cut off
+            end = size - size % RECORD.size
+            self.log.trim(end)
+            with open(self.path, "rb") as f:
+                while True:
+                    chunk = f.read(min(RECORD.size * READ_CHUNK, end - f.tell()))
+                    if not chunk:
+                        break
+                    for (txn, _, player, _, _, _) in RECORD.iter_unpack(chunk):
+                        numbers = self.index.get(player)
+                        if numbers is None:
+                            numbers = self.index[player] = array("I")
+                        numbers.append(count)
+                        count += 1
+                        self.txn = txn
+        self.written = count
+
+        if count == 0 and balances:
+            # committed by the caller, this thread has no event loop to schedule on
+            self._append([(player, bal, bal) for player, bal in balances.items()], "opening")
+
+    def empty(self):
+        return not exists(self.path) or os.path.getsize(self.path) < RECORD.size
+
+    def record(self, changes, reason):
+        """
+        Add one transaction: `(player, change, balance after)` for every
+        player it touched.
+        """
+        self._append(changes, reason)
+        self.log.schedule()
+
+    def _append(self, changes, reason):
+        self.txn = (self.txn + 1) & 0xFFFFFFFF
+        now = int(time.time())
+        code = REASON_CODES.get(reason, 0)
+        for player, change, balance in changes:
+            numbers = self.index.get(player)
+            if numbers is None:
+                numbers = self.index[player] = array("I")
+            numbers.append(self.written + len(self.log.pending))
+            self.log.pending.append(RECORD.pack(self.txn, now, player, change, balance, code))
+
+    async def commit(self):
+        async with self.log.lock:
+            pending = self.log.pending
+            count = len(pending)
+            if count == 0:
+                return
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._write, b"".join(pending[:count]))
+            # only now can readers find these on disk
+            del pending[:count]
+            self.written += count
+
+    def _write(self, data):
+        with persist_latency.time(store="ledger"):
+            self.log.append(data)
+
+    def count(self, player):
+        return len(self.index.get(player, ()))
+
+    async def history(self, player, start, count):
+        """
+        `player`'s entries newest first, skipping the latest `start`, as
+        `(time, change, balance, reason)`.
+        """
+        numbers = self.index.get(player)
+        if not numbers:
+            return []
+        end = max(len(numbers) - start, 0)
+        wanted = numbers[max(end - count, 0):end][::-1]
+
+        on_disk = [n for n in wanted if n < self.written]
+        records = {n: self.log.pending[n - self.written] for n in wanted if n >= self.written}
+        if on_disk:
+            loop = asyncio.get_event_loop()
+            records.update(await loop.run_in_executor(None, self._read, on_disk))
+        out = []
+        for n in wanted:
+            (_, ts, _, change, balance, code) = RECORD.unpack(records[n])
+            out.append((ts, change, balance, REASONS[code] if code < len(REASONS) else REASONS[0]))
+        return out
+
+    def _read(self, numbers):
+        with open(self.path, "rb") as f:
+            fd = f.fileno()
+            return {n: os.pread(fd, RECORD.size, n * RECORD.size) for n in numbers}
+
+    async def close(self):
+        self.log.stop()
+        await self.commit()
+        self.log.close_file()
+
+def audit(path, balances):
+    """
+    Replay the ledger at `path` and compare it against `balances`.
+    Returns a list of problems; empty when they agree.
+    """
+    problems = []
+    replayed = {}
+    if exists(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % RECORD.size]
+        for n, (txn, _, player, change, balance, code) in enumerate(RECORD.iter_unpack(data)):
+            before = replayed.get(player, 0)
+            if before + change != balance:
+                problems.append(
+                    f"record {n} (txn {txn}): player {player} went {before} {change:+} but recorded {balance}")
+            replayed[player] = balance
+
+    for player in sorted(set(replayed) | set(balances)):
+        (expected, actual) = (replayed.get(player), balances.get(player))
+        if expected != actual:
+            problems.append(f"player {player}: ledger ends at {expected}, wallet holds {actual}")
+    return problems
+
+if __name__ == "__main__":
+    # python -m modules.ledger [wallets.ledger] [wallets.db]; checks the text store without a db
+    path = sys.argv[1] if len(sys.argv) > 1 else LEDGER_FILE
+    if len(sys.argv) > 2:
+        conn = sqlite3.connect(sys.argv[2])
+        balances = dict(conn.execute("SELECT player, balance FROM wallets"))
+        conn.close()
+    else:
+        balances = WalletJournal(None).replay()
+    problems = audit(path, balances)
+    for problem in problems:
+        print(problem)
+    print(f"{len(problems)} problems in {path}")
+    sys.exit(1 if problems else 0)
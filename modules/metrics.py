@@ -0,0 +1,205 @@
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+from discord.ext import commands
+
+# Latency buckets in seconds, from a cache hit up to a slow youtube_dl call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# How often the text dump is rewritten when METRICS_FILE is set
+DUMP_INTERVAL = 15
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _fmt(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help) -> None:
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus layout, so p99 can be
+    read with `histogram_quantile`.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for key, (counts, total, n) in self.values.items():
+                seen = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    seen += count
+                    out.append((f"{self.name}_bucket", key + (("le", bound),), seen))
+                out.append((f"{self.name}_sum", key, total))
+                out.append((f"{self.name}_count", key, n))
+        return out
+
+class Gauge:
+    """
+    Read at export time from `fn`, which returns a number or a
+    `{labels dict as tuple: value}` mapping.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, fn) -> None:
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return [(self.name, key, v) for key, v in value.items()]
+        return [(self.name, (), value)]
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = {}
+
+    def _add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn):
+        # gauges are re-registered when their owner is recreated, keep the newest
+        self.metrics[name] = Gauge(name, help, fn)
+        return self.metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Error reading metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in samples:
+                lines.append(f"{name}{_fmt(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Registry()
+
+command_latency = metrics.histogram("chimp_command_seconds", "Time from command dispatch to completion")
+extract_latency = metrics.histogram("chimp_extract_seconds", "youtube_dl extraction time in the pool")
+extract_wait = metrics.histogram("chimp_extract_wait_seconds", "Time an extraction waited for its guild's slot")
+ffmpeg_spawn = metrics.histogram("chimp_ffmpeg_spawn_seconds", "Time to start an FFmpeg source")
+queue_wait = metrics.histogram("chimp_queue_wait_seconds", "Time a song sat in the queue before playing")
+persist_latency = metrics.histogram("chimp_persist_seconds", "Time to write and fsync persisted state")
+send_latency = metrics.histogram("chimp_discord_send_seconds", "Discord message send and edit latency")
+outbox_events = metrics.counter("chimp_outbox_total", "Outbound messages sent, merged, replaced or dropped")
+errors = metrics.counter("chimp_errors_total", "Errors by where they were caught")
+
+class MetricsModule(commands.Cog):
+    """
+    Times every command and exports the registry, either on a local
+    Prometheus text endpoint (`port`) or as a file rewritten every
+    DUMP_INTERVAL seconds (`path`).
+    """
+    def __init__(self, bot, port=None, path=None) -> None:
+        super().__init__()
+        self.bot = bot
+        self.port = int(port) if port else None
+        self.path = path
+        self.runner = None
+        self.tasks = []
+        bot.before_invoke(self.before_invoke)
+        bot.after_invoke(self.after_invoke)
+        if self.port:
+            self.tasks.append(bot.loop.create_task(self.serve()))
+        if self.path:
+            self.tasks.append(bot.loop.create_task(self.dump_loop()))
+
+    def cog_unload(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.runner is not None:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    async def before_invoke(self, ctx):
+        ctx.metrics_start = time.perf_counter()
+
+    async def after_invoke(self, ctx):
+        start = getattr(ctx, "metrics_start", None)
+        if start is None:
+            return
+        status = "error" if ctx.command_failed else "ok"
+        command_latency.observe(time.perf_counter() - start, command=ctx.command.qualified_name, status=status)
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def handle(self, request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    async def dump_loop(self):
+        while True:
+            await asyncio.sleep(DUMP_INTERVAL)
+            text = metrics.render()
+            await self.bot.loop.run_in_executor(None, self._dump, text)
+
+    def _dump(self, text):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, self.path)
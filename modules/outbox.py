@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+
+from modules.metrics import metrics, send_latency, outbox_events, errors
+
+# Discord rejects embed descriptions longer than this
+DESCRIPTION_LIMIT = 4096
+# Posts waiting per channel before the oldest status updates (`key` or
+# `merge` posts) are dropped; one-off replies are always sent
+MAX_PENDING = 25
+
+class Post:
+    __slots__ = ("content", "embed", "merge", "key", "waiters")
+
+    def __init__(self, content, embed, merge, key) -> None:
+        self.content = content
+        self.embed = embed
+        self.merge = merge
+        self.key = key
+        self.waiters = []
+
+    def droppable(self):
+        """
+        Whether this is a status update a later post makes redundant,
+        rather than a result someone has to see.
+        """
+        return not self.waiters and (self.key is not None or self.merge)
+
+    def same(self, other):
+        return self.content == other.content and _as_dict(self.embed) == _as_dict(other.embed)
+
+    def absorb(self, other):
+        """
+        Fold `other`'s description into this embed, if both asked to be
+        merged and differ only by description.
+        """
+        if not (self.merge and other.merge) or self.content or other.content:
+            return False
+        (mine, theirs) = (_as_dict(self.embed), _as_dict(other.embed))
+        if mine is None or theirs is None or "fields" in mine or "fields" in theirs:
+            return False
+        if mine.pop("description", None) is None or theirs.pop("description", None) is None or mine != theirs:
+            return False
+        description = f"{self.embed.description}\n{other.embed.description}"
+        if len(description) > DESCRIPTION_LIMIT:
+            return False
+        self.embed.description = description
+        return True
+
+class Outbox:
+    """
+    Sends messages in the background, one at a time per channel, so a
+    command can return without waiting on the Discord API.
+
+    Whatever queues up behind a send (usually because discord.py is
+    sleeping off a 429) is reduced before it goes out: an identical post
+    is dropped, a post with the same `key` replaces the pending one, and
+    consecutive `merge` embeds with the same title become one embed with
+    a line per post. The busier a channel, the fewer messages it costs.
+    Past MAX_PENDING the oldest `key` and `merge` posts are shed, but
+    plain posts, like a bet's result or an error reply, always go out.
+    """
+    def __init__(self) -> None:
+        self.pending = {}
+        self.tasks = {}
+
+    def post(self, channel, content=None, *, embed=None, merge=False, key=None):
+        """
+        Queue a message for `channel` and return immediately.
+        """
+        self._queue(channel, Post(content, embed, merge, key))
+
+    async def send(self, channel, content=None, *, embed=None):
+        """
+        Queue a message behind anything already pending for `channel` and
+        wait for the sent `discord.Message`.
+        """
+        post = Post(content, embed, False, None)
+        waiter = asyncio.get_event_loop().create_future()
+        post.waiters.append(waiter)
+        self._queue(channel, post)
+        return await waiter
+
+    def react(self, message, emoji):
+        asyncio.ensure_future(self._react(message, emoji))
+
+    def _queue(self, channel, post):
+        queue = self.pending.setdefault(channel.id, deque())
+        last = queue[-1] if queue else None
+        if post.key is not None:
+            for old in queue:
+                if old.key == post.key:
+                    queue.remove(old)
+                    post.waiters.extend(old.waiters)
+                    outbox_events.inc(result="replaced")
+                    break
+        elif last is not None and not post.waiters and (last.same(post) or last.absorb(post)):
+            outbox_events.inc(result="merged")
+            return
+        queue.append(post)
+
+        while len(queue) > MAX_PENDING:
+            oldest = next((old for old in queue if old.droppable()), None)
+            if oldest is None:
+                break
+            queue.remove(oldest)
+            outbox_events.inc(result="dropped")
+
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.ensure_future(self._drain(channel))
+
+    async def _drain(self, channel):
+        queue = self.pending[channel.id]
+        try:
+            while queue:
+                post = queue.popleft()
+                try:
+                    with send_latency.time(op="send"):
+                        message = await channel.send(post.content, embed=post.embed)
+                except Exception as e:
+                    errors.inc(where="send")
+                    print(f"Error sending message: {e}")
+                    for waiter in post.waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                outbox_events.inc(result="sent")
+                for waiter in post.waiters:
+                    if not waiter.done():
+                        waiter.set_result(message)
+        finally:
+            del self.tasks[channel.id]
+            del self.pending[channel.id]
+
+    async def _react(self, message, emoji):
+        try:
+            await message.add_reaction(emoji)
+        except Exception as e:
+            errors.inc(where="send")
+            print(f"Error adding reaction: {e}")
+
+    def depth(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    async def close(self):
+        """
+        Wait for everything queued so far to be sent.
+        """
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+def _as_dict(embed):
+    return embed.to_dict() if embed is not None else None
+
+outbox = Outbox()
+
+metrics.gauge("chimp_outbox_pending", "Messages queued to send across every channel", outbox.depth)
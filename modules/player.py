@@ -1,51 +1,329 @@
 import asyncio
+import difflib
+import heapq
+import itertools
+import time
+from collections import deque
 from dataclasses import dataclass, field
-from functools import partial
-from pydoc import describe
 from typing import Any
 
 import discord
-import youtube_dl
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from modules.wallet import InsufficientFundsError, NoWalletError
+from modules.errors import InvalidCommandUsage
+from modules.cache import ExtractionCache, AudioCache
+from modules.extractor import Extractor, is_playlist, prepare_filename, PLAYLIST_PAGE
 from modules.embed import COLOUR
+from modules.metrics import metrics, ffmpeg_spawn, queue_wait, errors
+from modules.outbox import outbox
+from modules.voice import VoiceSessions
 
 PREMIUM_COST = 20
 
-# Suppress noise about console usage from errors
-youtube_dl.utils.bug_reports_message = lambda: ''
-
-
-ytdl_format_options = {
-    'filter': 'audioonly',
-    'highWaterMark': 1<<25,
-    'format': 'bestaudio',
-    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',  # bind to ipv4 since ipv6 addresses cause issues sometimes
-}
+# Seconds a guild's player may sit with an empty queue before it is torn down
+IDLE_TIMEOUT = 300
+
+# How many upcoming songs to resolve while the current one plays, and how long
+# a resolved stream URL is trusted before it is re-extracted
+PREFETCH_DEPTH = 2
+PREFETCH_TTL = 600
+
+# `$queue` page size, and how close a `$skip <name>` has to be to a title
+QUEUE_PAGE = 10
+FUZZY_CUTOFF = 0.6
 
 ffmpeg_options = {
     'options': '-vn',
 }
 
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+VOLUME = 0.5
+
+extraction_cache = ExtractionCache()
+audio_cache = AudioCache()
+extractor = Extractor()
 
 @dataclass(order=True)
 class PrioritizedSong:
-    priority: int
+    priority: float
+    seq: float
     item: Any=field(compare=False)
+    removed: bool=field(default=False, compare=False)
+
+    @property
+    def key(self):
+        return (self.priority, self.seq)
+
+class Song:
+    """
+    A queued request. Its stream info can be resolved ahead of time
+    with `prefetch`, and `resolve` hands back that result if it is still fresh.
+    """
+    def __init__(self, ctx, query) -> None:
+        self.ctx = ctx
+        self.query = query
+        self.task = None
+        self.resolved_at = 0
+        self.queued_at = time.monotonic()
+        self.title = None
+        self.on_title = None
+
+    def expired(self):
+        return time.monotonic() - self.resolved_at > PREFETCH_TTL
+
+    def prefetch(self, loop):
+        if self.task is not None and not self.expired():
+            return
+        self.cancel()
+        self.resolved_at = time.monotonic()
+        self.task = loop.create_task(YTDLSource.extract(self.query, loop=loop, guild_id=self.ctx.guild.id))
+        self.task.add_done_callback(self._resolved)
+
+    def _resolved(self, task):
+        # retrieve failures here so an unused prefetch doesn't log "never retrieved"
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.title is None:
+            self.title = task.result().get('title')
+            if self.title and self.on_title is not None:
+                self.on_title(self)
+
+    async def resolve(self, loop):
+        self.prefetch(loop)
+        return await self.task
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+class PlaylistFeed:
+    """
+    A whole playlist as one queue entry. Entries are flat-extracted a
+    page at a time, the next page only once the buffer runs low, and each
+    becomes a `Song` that is resolved like any other just before it plays.
+    """
+    def __init__(self, ctx, query) -> None:
+        self.ctx = ctx
+        self.query = query
+        self.buffer = deque()
+        self.next_index = 1
+        self.exhausted = False
+        self.task = None
+        self.queued_at = time.monotonic()
+
+    @property
+    def done(self):
+        return self.exhausted and not self.buffer and self.task is None
+
+    def fill(self, loop):
+        if self.task is None and not self.exhausted and len(self.buffer) <= PREFETCH_DEPTH:
+            self.task = loop.create_task(self._fetch(loop))
+
+    async def _fetch(self, loop):
+        try:
+            urls = await extractor.playlist_page(self.query, self.next_index, guild_id=self.ctx.guild.id, loop=loop)
+        except Exception as e:
+            errors.inc(where="playlist")
+            print(f"Error reading playlist {self.query}: {e}")
+            urls = []
+        finally:
+            self.task = None
+        self.next_index += PLAYLIST_PAGE
+        if len(urls) < PLAYLIST_PAGE:
+            self.exhausted = True
+        self.buffer.extend(Song(self.ctx, url) for url in urls)
+
+    async def next_song(self, loop):
+        if not self.buffer:
+            self.fill(loop)
+            if self.task is not None:
+                await asyncio.shield(self.task)
+        if not self.buffer:
+            return None
+        song = self.buffer.popleft()
+        self.fill(loop)
+        return song
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for song in self.buffer:
+            song.cancel()
+        self.buffer.clear()
+        self.exhausted = True
+
+class MusicQueue:
+    """
+    Priority queue of songs and playlist feeds, FIFO within a priority.
+    Entries live in a heap with lazy deletion plus indexes by their
+    `(priority, seq)` key and by normalized query/title, so removing, finding and
+    reordering don't wait for an entry to reach the head.
+    """
+    def __init__(self) -> None:
+        self.heap = []
+        self.entries = {}
+        self.by_name = {}
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+
+    def push(self, priority, item):
+        entry = PrioritizedSong(priority, next(self.counter), item)
+        self.put_back(entry)
+        return entry
+
+    def put_back(self, entry):
+        entry.removed = False
+        heapq.heappush(self.heap, entry)
+        self.entries[entry.key] = entry
+        self._index(entry, entry.item.query)
+        if isinstance(entry.item, Song):
+            if entry.item.title:
+                self._index(entry, entry.item.title)
+            entry.item.on_title = lambda song, entry=entry: self._index(entry, song.title)
+        self.changed.set()
+
+    def _index(self, entry, name):
+        if entry.key in self.entries:
+            self.by_name.setdefault(normalize(name), set()).add(entry.key)
+
+    def _unindex(self, entry):
+        item = entry.item
+        for name in (item.query, getattr(item, 'title', None)):
+            if not name:
+                continue
+            keys = self.by_name.get(normalize(name))
+            if keys is not None:
+                keys.discard(entry.key)
+                if not keys:
+                    del self.by_name[normalize(name)]
+
+    def remove(self, entry):
+        if self.entries.pop(entry.key, None) is not entry:
+            return
+        entry.removed = True
+        self._unindex(entry)
+        # drop dead heap slots once they outnumber live ones
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def _pop(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry.removed:
+                continue
+            del self.entries[entry.key]
+            self._unindex(entry)
+            return entry
+        return None
+
+    async def get(self):
+        while not self.entries:
+            self.changed.clear()
+            await self.changed.wait()
+        return self._pop()
+
+    def qsize(self):
+        return len(self.entries)
+
+    def peek(self, n):
+        return [entry.item for entry in heapq.nsmallest(n, self.entries.values())]
+
+    def ordered(self, start=0, stop=None):
+        """
+        Live entries in play order, sliced to `start`..`stop`.
+        """
+        stop = len(self.entries) if stop is None else stop
+        return heapq.nsmallest(stop, self.entries.values())[start:]
+
+    def at(self, position):
+        """
+        The entry at 1-based `position` in play order, or None.
+        """
+        if not 1 <= position <= len(self.entries):
+            return None
+        return self.ordered(position - 1, position)[0]
+
+    def find(self, name):
+        """
+        The next entry whose query or title matches `name`: exactly,
+        then as a substring, then by fuzzy match.
+        """
+        wanted = normalize(name)
+        keys = self.by_name.get(wanted)
+        if not keys:
+            names = [n for n in self.by_name if wanted in n]
+            names = names or difflib.get_close_matches(wanted, self.by_name.keys(), n=3, cutoff=FUZZY_CUTOFF)
+            keys = set().union(*(self.by_name[n] for n in names)) if names else None
+        if not keys:
+            return None
+        return min(self.entries[key] for key in keys)
+
+    def move(self, entry, position):
+        """
+        Reorder `entry` to play at 1-based `position`.
+        """
+        self.remove(entry)
+        (priority, seq) = self._gap(entry, position)
+        if seq is None:
+            # repeated moves have halved this gap down to float precision
+            self._renumber(priority)
+            (priority, seq) = self._gap(entry, position)
+        # a fresh entry, the old one may still sit in the heap marked removed
+        moved = PrioritizedSong(priority, seq, entry.item)
+        self.put_back(moved)
+        return moved
+
+    def _gap(self, entry, position):
+        """
+        The `(priority, seq)` key that sorts at 1-based `position`; seq is
+        None if the neighbours there are too close to fit one between.
+        """
+        ahead = self.ordered(0, max(position - 1, 0))
+        behind = self.ordered(len(ahead), len(ahead) + 1)
+        if behind:
+            after = behind[0]
+            before = ahead[-1] if ahead else None
+            if before is not None and before.priority == after.priority:
+                seq = (before.seq + after.seq) / 2
+                return (after.priority, seq if before.seq < seq < after.seq else None)
+            return (after.priority, after.seq - 1)
+        if ahead:
+            return (ahead[-1].priority, next(self.counter))
+        return (entry.priority, entry.seq)
+
+    def _renumber(self, priority):
+        """
+        Give every entry of `priority` a fresh whole seq, keeping their order.
+        """
+        for old in self.ordered():
+            if old.priority == priority:
+                self.remove(old)
+                self.put_back(PrioritizedSong(priority, next(self.counter), old.item))
+
+    def dedupe(self):
+        """
+        Drop every entry that repeats an earlier one's query, returning how many went.
+        """
+        seen = set()
+        dropped = []
+        for entry in self.ordered():
+            key = normalize(entry.item.query)
+            if key in seen:
+                dropped.append(entry)
+            seen.add(key)
+        for entry in dropped:
+            self.remove(entry)
+            entry.item.cancel()
+        return len(dropped)
+
+def normalize(name):
+    return " ".join(name.lower().split())
 
 class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
+    def __init__(self, source, *, data, volume=VOLUME):
         super().__init__(source, volume)
 
         self.data = data
@@ -55,111 +333,368 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+        data = await cls.extract(url, loop=loop, stream=stream)
+        return cls.from_data(data, stream=stream)
+
+    @staticmethod
+    async def extract(url, *, loop=None, stream=True, guild_id=None):
+        if stream:
+            data = extraction_cache.get(url)
+            if data is not None:
+                return data
 
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+        data = await extractor.extract(url, download=not stream, guild_id=guild_id, loop=loop)
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
+        if stream:
+            extraction_cache.put(url, data)
+        return data
+
+    @classmethod
+    def from_data(cls, data, *, stream=True):
+        filename = data['url'] if stream else prepare_filename(data)
         return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
 
+    @classmethod
+    def from_file(cls, path, data):
+        return cls(discord.FFmpegPCMAudio(path, **ffmpeg_options), data=data)
+
     @classmethod
     async def regather_stream(cls, data, *, loop):
         """Used for preparing a stream, instead of downloading.
         Since Youtube Streaming links expire."""
-        loop = loop or asyncio.get_event_loop()
-        requester = data['requester']
+        data = await cls.extract(data['webpage_url'], loop=loop)
+        return cls.from_data(data)
 
-        to_run = partial(ytdl.extract_info, url=data['webpage_url'], download=False)
-        data = await loop.run_in_executor(None, to_run)
+class YTDLOpusSource(discord.FFmpegOpusAudio):
+    """
+    Passthrough alternative to `YTDLSource`. Opus input (YouTube's webm
+    audio, or a cached .opus file) is copied into Discord's packets as is,
+    so FFmpeg doesn't decode it and Python never scales or re-encodes a
+    frame; it plays at its source volume. Anything else is encoded to Opus
+    once by FFmpeg, with the volume applied as an FFmpeg filter.
+    """
+    def __init__(self, source, *, data, codec=None):
+        options = ffmpeg_options['options']
+        if codec != 'opus':
+            options += f" -filter:a volume={VOLUME}"
+        super().__init__(source, codec=codec, options=options)
 
-        return cls(discord.FFmpegPCMAudio(data['url']), data=data, requester=requester)
+        self.data = data
+
+        self.title = data.get('title')
+        self.url = data.get('url')
+
+    @classmethod
+    def from_data(cls, data, *, stream=True):
+        filename = data['url'] if stream else prepare_filename(data)
+        return cls(filename, data=data, codec=data.get('acodec'))
+
+    @classmethod
+    def from_file(cls, path, data):
+        return cls(path, data=data, codec='opus')
+
+# `$play` sources by PLAYBACK_MODE
+SOURCES = {
+    "pcm": YTDLSource,
+    "opus": YTDLOpusSource,
+}
+
+class GuildPlayer:
+    """
+    Queue and playback loop for a single guild. Created on the first
+    `$play` in a guild and torn down once nothing has been queued for
+    IDLE_TIMEOUT seconds.
+    """
+    def __init__(self, bot, guild_id, on_idle, voice, source=YTDLSource) -> None:
+        self.bot = bot
+        self.guild_id = guild_id
+        self.on_idle = on_idle
+        self.voice = voice
+        self.source = source
+        self.queue = MusicQueue()
+        self.next = asyncio.Event()
+        self.task = bot.loop.create_task(self.play_loop())
+
+    async def play_loop(self):
+        while True:
+            if self.queue.qsize() == 0:
+                self.voice.idle(self.guild_id)
+            try:
+                next = await asyncio.wait_for(self.queue.get(), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.on_idle(self.guild_id)
+                return
+
+            self.next.clear()
+            song = next.item
+            if self.guild_id not in self.voice:
+                # `$stop` or a kick ended the session; don't resolve songs nobody will hear
+                next.item.cancel()
+                self.clear()
+                embed = discord.Embed(title="Left the voice channel, the queue has been cleared", colour=COLOUR)
+                outbox.post(song.ctx.channel, embed=embed, key="now-playing")
+                continue
+            if isinstance(song, PlaylistFeed):
+                feed = song
+                song = await feed.next_song(self.bot.loop)
+                if not feed.done and not next.removed:
+                    # keeps its place, so the rest of the playlist still plays before later requests
+                    self.queue.put_back(next)
+                if song is None:
+                    continue
+
+            ctx = song.ctx
+            queue_wait.observe(time.monotonic() - song.queued_at)
+
+            try:
+                data = await song.resolve(self.bot.loop)
+                client = await self.voice.ensure(self.guild_id)
+                if client is None:
+                    raise RuntimeError("not connected to a voice channel")
+                key = data.get('webpage_url')
+                local = audio_cache.get(key)
+                with ffmpeg_spawn.time():
+                    player = self.source.from_file(local, data) if local else self.source.from_data(data)
+                if audio_cache.wants(key):
+                    self.bot.loop.create_task(cache_audio(key))
+                client.play(player, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
+                self.voice.busy(self.guild_id)
+                self.prefetch()
+                embed = discord.Embed(title="Now playing", description=player.title, colour=COLOUR)
+                # only the latest track is worth announcing if the channel is backed up
+                outbox.post(ctx.channel, embed=embed, key="now-playing")
+            except Exception as e:
+                errors.inc(where="play")
+                self.next.set()
+                embed = discord.Embed(title="Error", description="error playing song", color=COLOUR)
+                outbox.post(ctx.channel, embed=embed)
+                print(f"Error playing {e}")
+            finally:
+                await self.next.wait()
+
+    async def put(self, priority, ctx, val):
+        item = PlaylistFeed(ctx, val) if is_playlist(val) else Song(ctx, val)
+        self.queue.push(priority, item)
+        self.prefetch()
+
+    def upcoming(self, n):
+        """
+        The next `n` songs in play order, looking into playlist feeds.
+        """
+        out = []
+        for item in self.queue.peek(n):
+            if isinstance(item, PlaylistFeed):
+                item.fill(self.bot.loop)
+                out.extend(itertools.islice(item.buffer, n - len(out)))
+            else:
+                out.append(item)
+            if len(out) >= n:
+                break
+        return out
+
+    def prefetch(self):
+        for song in self.upcoming(PREFETCH_DEPTH):
+            song.prefetch(self.bot.loop)
+
+    def skip(self, entry):
+        """
+        Take `entry` out of the queue now, before anything is resolved for it.
+        """
+        self.queue.remove(entry)
+        entry.item.cancel()
+        self.prefetch()
+
+    def clear(self):
+        for entry in self.queue.ordered():
+            self.queue.remove(entry)
+            entry.item.cancel()
+
+    def destroy(self):
+        self.task.cancel()
+        for song in self.queue.peek(self.queue.qsize()):
+            song.cancel()
+
+def find_entry(player, name):
+    if player is None:
+        return None
+    if name.isdigit():
+        return player.queue.at(int(name))
+    return player.queue.find(name)
+
+def describe_entry(entry):
+    item = entry.item
+    if isinstance(item, PlaylistFeed):
+        return f"Playlist: {item.query}"
+    return item.title or item.query
+
+async def cache_audio(key):
+    try:
+        await audio_cache.fill(key, extractor.download)
+    except Exception as e:
+        errors.inc(where="audio_cache")
+        print(f"Error caching audio for {key}: {e}")
 
 class MusicModule(commands.Cog):
-    def __init__(self, bot, wallet) -> None:
+    def __init__(
+            self, bot, wallet, cache_file=None, extract_mode=None, extract_workers=None,
+            audio_dir=None, audio_size=None, playback=None, voice_idle=None) -> None:
         super().__init__()
         self.bot = bot
         self.wallet = wallet
-        self.queue = asyncio.PriorityQueue()
-        self.next = asyncio.Event()
-        self.play_loop.start()
-        self.skips = set()  
+        self.players = {}
+        self.voice = VoiceSessions(voice_idle)
+        self.source = SOURCES[playback or "pcm"]
+        bot.loop.create_task(self.load_cache(cache_file))
+        extractor.start(extract_mode, extract_workers)
+        audio_cache.load(audio_dir, audio_size)
+        metrics.gauge("chimp_players", "Guilds with an active music player", lambda: len(self.players))
+        metrics.gauge("chimp_voice_sessions", "Open voice connections", lambda: len(self.voice))
+        metrics.gauge(
+            "chimp_queue_depth", "Songs waiting across every guild's queue",
+            lambda: sum(player.queue.qsize() for player in self.players.values()))
+        metrics.gauge(
+            "chimp_extraction_cache", "Extraction cache entries, hits and misses",
+            lambda: {(("stat", name),): value for name, value in extraction_cache.stats().items()})
+        metrics.gauge(
+            "chimp_audio_cache", "On-disk audio cache entries, bytes, hits and misses",
+            lambda: {(("stat", name),): value for name, value in audio_cache.stats().items()})
 
-    @tasks.loop()
-    async def play_loop(self):
-        self.next.clear()
-        next = await self.queue.get()
-        (ctx, url) = next.item
-        if url in self.skips:
-            self.skips.remove(url)
-            return
+    async def load_cache(self, cache_file):
+        saved = await self.bot.loop.run_in_executor(None, extraction_cache.read, cache_file)
+        extraction_cache.restore(cache_file, saved)
 
-        try:
-            player = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
-            ctx.voice_client.play(player, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-            embed = discord.Embed(title="Now playing", description=player.title, colour=COLOUR)
-            await ctx.send(embed=embed)
-        except Exception as e:
-            embed = discord.Embed(title="Error", description="error playing song", color=COLOUR)
-            await ctx.send(embed=embed)
-            print(f"Error playing {e}")
-        finally:
-            await self.next.wait()
-        
-    @play_loop.before_loop
-    async def before_play_loop(self):
-        await self.bot.wait_until_ready()
+    def get_player(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            player = GuildPlayer(self.bot, ctx.guild.id, self.remove_player, self.voice, self.source)
+            self.players[ctx.guild.id] = player
+        return player
+
+    def remove_player(self, guild_id):
+        self.players.pop(guild_id, None)
+        extractor.forget(guild_id)
+
+    def cog_unload(self):
+        for player in self.players.values():
+            player.destroy()
+        self.players.clear()
+        self.bot.loop.create_task(self.voice.close())
+        extraction_cache.save()
+        extractor.shutdown()
     
     @commands.command(name="play")
     async def play(self, ctx, *, val):
-        embed = discord.Embed(title="Added to queue", desciption=val, colour=COLOUR)
-        await ctx.send(embed=embed)
-        await self.queue.put(PrioritizedSong(10, (ctx, val)))
+        title = "Added playlist to queue" if is_playlist(val) else "Added to queue"
+        embed = discord.Embed(title=title, description=val, colour=COLOUR)
+        outbox.post(ctx.channel, embed=embed, merge=True)
+        await self.get_player(ctx).put(10, ctx, val)
     
     @commands.command(name="p-play")
     async def premium_play(self, ctx, *, val):
         user = ctx.author.id
         player_name = ctx.author.name
         try:
-            self.wallet.withdraw(user, PREMIUM_COST)
+            await self.wallet.withdraw(user, PREMIUM_COST, "premium")
             embed = discord.Embed(
                 title="A premium play has been purchased",
                 description=f"Request: {val}",
                 colour=COLOUR)
             embed.set_footer(text=f"{player_name} skipped the queue", icon_url=ctx.author.avatar_url)
-            await ctx.send(embed=embed)
-            await self.queue.put(PrioritizedSong(0, (ctx, val)))
+            outbox.post(ctx.channel, embed=embed)
+            await self.get_player(ctx).put(0, ctx, val)
         except NoWalletError:
             embed = discord.Embed(title=f"Cannot place bet", description=f"{player_name} does not have a Chimp-wallet yet!", color=COLOUR)
             embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
         except InsufficientFundsError:
             embed = discord.Embed(title="You cannot afford a premium play!", colour=COLOUR)
             embed.set_footer(text=f"Premium plays cost {PREMIUM_COST} Chimp-coins")
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
     
     @commands.command(name="skip")
     async def skip(self, ctx, *, name=None):
         if ctx.voice_client is None:
             embed = discord.Embed(title="No song is playing to skip", colour=COLOUR)
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
             return
         if name is None:
-            msg = ctx.message.id
-            msg = await ctx.fetch_message(msg)
-            await msg.add_reaction("\U0001F44C")
+            outbox.react(ctx.message, "\U0001F44C")
             ctx.voice_client.stop()
         else:
-            embed = discord.Embed(title=f"Added to skips: {name}", colour=COLOUR)
-            await ctx.send(embed=embed)
-            self.skips.add(name)
+            player = self.players.get(ctx.guild.id)
+            entry = find_entry(player, name)
+            if entry is None:
+                raise InvalidCommandUsage(f"Nothing in the queue matches {name}")
+            player.skip(entry)
+            embed = discord.Embed(title="Skipped", description=describe_entry(entry), colour=COLOUR)
+            outbox.post(ctx.channel, embed=embed, merge=True)
+
+    @commands.command(name="queue")
+    async def queue(self, ctx, page: int=1):
+        player = self.players.get(ctx.guild.id)
+        if player is None or player.queue.qsize() == 0:
+            embed = discord.Embed(title="The queue is empty", colour=COLOUR)
+            outbox.post(ctx.channel, embed=embed)
+            return
+        pages = (player.queue.qsize() + QUEUE_PAGE - 1) // QUEUE_PAGE
+        page = min(max(page, 1), pages)
+        start = (page - 1) * QUEUE_PAGE
+        entries = player.queue.ordered(start, start + QUEUE_PAGE)
+        lines = "".join(f"{start + i}. {describe_entry(entry)}\n" for i, entry in enumerate(entries, 1))
+        embed = discord.Embed(title="Queue", description=lines, colour=COLOUR)
+        embed.set_footer(text=f"Page {page} of {pages} • `$skip <position or name>` to remove a song")
+        outbox.post(ctx.channel, embed=embed, key="queue")
+
+    @commands.command(name="move")
+    async def move(self, ctx, position: int, to: int):
+        player = self.players.get(ctx.guild.id)
+        entry = find_entry(player, str(position))
+        if entry is None:
+            raise InvalidCommandUsage(f"There is no song at position {position}")
+        player.queue.move(entry, to)
+        player.prefetch()
+        embed = discord.Embed(title=f"Moved to position {to}", description=describe_entry(entry), colour=COLOUR)
+        outbox.post(ctx.channel, embed=embed)
+
+    @commands.command(name="dedupe")
+    async def dedupe(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        dropped = player.queue.dedupe() if player is not None else 0
+        embed = discord.Embed(title=f"Removed {dropped} duplicate songs from the queue", colour=COLOUR)
+        outbox.post(ctx.channel, embed=embed)
+
+    @commands.command(name="pin")
+    async def pin(self, ctx, *, val):
+        if not audio_cache.enabled:
+            raise InvalidCommandUsage("The audio cache is not enabled")
+        data = await YTDLSource.extract(val, loop=self.bot.loop, guild_id=ctx.guild.id)
+        key = data.get('webpage_url')
+        if not key:
+            raise InvalidCommandUsage("That song can't be pinned")
+        audio_cache.pin(key)
+        if audio_cache.wants(key):
+            self.bot.loop.create_task(cache_audio(key))
+        embed = discord.Embed(title="Pinned to the audio cache", description=data.get('title'), colour=COLOUR)
+        outbox.post(ctx.channel, embed=embed)
+
+    @commands.command(name="unpin")
+    async def unpin(self, ctx, *, val):
+        if not audio_cache.enabled:
+            raise InvalidCommandUsage("The audio cache is not enabled")
+        data = await YTDLSource.extract(val, loop=self.bot.loop, guild_id=ctx.guild.id)
+        key = data.get('webpage_url')
+        if not key or not audio_cache.unpin(key):
+            raise InvalidCommandUsage("That song isn't pinned")
+        embed = discord.Embed(title="Unpinned from the audio cache", description=data.get('title'), colour=COLOUR)
+        outbox.post(ctx.channel, embed=embed)
 
     @commands.command(name="stop")
     async def stop(self, ctx):
-        if ctx.voice_client:
-            await ctx.voice_client.disconnect()
+        player = self.players.get(ctx.guild.id)
+        if player is not None:
+            player.destroy()
+            self.remove_player(ctx.guild.id)
+        await self.voice.disconnect(ctx.guild.id)
 
     @commands.command(name="pause")
     async def pause(self, ctx):
@@ -174,14 +709,16 @@ class MusicModule(commands.Cog):
     @play.before_invoke
     @premium_play.before_invoke
     async def ensure_voice(self, ctx):
-        if ctx.voice_client is None:
-            if ctx.author.voice:
-                await ctx.author.voice.channel.connect()
-            else:
-                embed = discord.Embed(title="You are not connected to a voice channel.", colour=COLOUR)
-                await ctx.send(embed=embed)
-                raise commands.CommandError("Author not connected to a voice channel.")
-    
-    @premium_play.after_invoke
-    async def persist_wallets(self, ctx):
-        await self.wallet.persist()
\ No newline at end of file
+        if self.voice.active(ctx.guild.id):
+            return
+        if ctx.author.voice:
+            await self.voice.connect(ctx.author.voice.channel)
+        else:
+            embed = discord.Embed(title="You are not connected to a voice channel.", colour=COLOUR)
+            outbox.post(ctx.channel, embed=embed)
+            raise commands.CommandError("Author not connected to a voice channel.")
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id and after.channel is None:
+            self.voice.dropped(member.guild.id)
@@ -0,0 +1,224 @@
+import random
+from collections import defaultdict
+
+# Enough levels for a few million players at the default promotion odds
+MAX_LEVEL = 24
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level) -> None:
+        self.key = key
+        self.next = [None] * level
+        # positions to step over to reach next[level]; a missing next sits at size + 1
+        self.width = [1] * level
+
+def _level():
+    level = 1
+    while level < MAX_LEVEL and random.getrandbits(1):
+        level += 1
+    return level
+
+class RankIndex:
+    """
+    Indexable skip list of unique, ordered keys. Insert, remove, rank
+    and positional lookup are all O(log n): each link also stores how
+    many positions it skips, so a search counts its way to a rank.
+    """
+    def __init__(self) -> None:
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = 0
+
+    @classmethod
+    def from_sorted(cls, keys):
+        """
+        Build from already sorted keys in O(n).
+        """
+        index = cls()
+        last = [index.head] * MAX_LEVEL
+        last_pos = [0] * MAX_LEVEL
+        pos = 0
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, _level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = pos - last_pos[level]
+                last[level] = node
+                last_pos[level] = pos
+        for level in range(MAX_LEVEL):
+            last[level].width[level] = pos + 1 - last_pos[level]
+        index.size = pos
+        return index
+
+    def _chain(self, key):
+        """
+        The last node before `key` on every level, and the position of each.
+        """
+        chain = [None] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node = self.head
+        pos = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = pos
+        return chain, positions
+
+    def insert(self, key):
+        chain, positions = self._chain(key)
+        node = _Node(key, _level())
+        pos = positions[0] + 1
+        for level in range(len(node.next)):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = positions[level] + prev.width[level] + 1 - pos
+            prev.width[level] = pos - positions[level]
+        for level in range(len(node.next), MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """
+        How many keys sort before `key`.
+        """
+        node = self.head
+        pos = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+        return pos
+
+    def slice(self, start, stop):
+        """
+        Keys at positions `start` up to `stop`, zero based.
+        """
+        node = self.head
+        pos = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and pos + node.width[level] <= start:
+                pos += node.width[level]
+                node = node.next[level]
+        out = []
+        node = node.next[0]
+        while node is not None and len(out) < stop - start:
+            out.append(node.key)
+            node = node.next[0]
+        return out
+
+    def __len__(self):
+        return self.size
+
+class Leaderboard:
+    """
+    Players ordered richest first, ties going to the lower player id.
+    """
+    def __init__(self, scores=None) -> None:
+        self.scores = dict(scores or {})
+        self.index = RankIndex.from_sorted(sorted((-bal, player) for player, bal in self.scores.items()))
+
+    def update(self, player, balance):
+        old = self.scores.get(player)
+        if old == balance:
+            return
+        if old is not None:
+            self.index.remove((-old, player))
+        self.scores[player] = balance
+        self.index.insert((-balance, player))
+
+    def discard(self, player):
+        old = self.scores.pop(player, None)
+        if old is not None:
+            self.index.remove((-old, player))
+
+    def top(self, start, stop):
+        return [(player, -neg) for neg, player in self.index.slice(start, stop)]
+
+    def rank(self, player):
+        """
+        1-based position of `player`, or None without a wallet.
+        """
+        bal = self.scores.get(player)
+        if bal is None:
+            return None
+        return self.index.rank((-bal, player)) + 1
+
+    def __len__(self):
+        return len(self.index)
+
+class Leaderboards:
+    """
+    The global leaderboard plus one per guild. A guild's board is built
+    from its member list the first time it is asked for, then kept up to
+    date by `update` and the member join/leave hooks.
+    """
+    def __init__(self, balances=None) -> None:
+        self.everyone = Leaderboard(balances)
+        self.guilds = {}
+        self.members = {}
+        self.memberships = defaultdict(set)
+
+    def update(self, player, balance):
+        self.everyone.update(player, balance)
+        for guild_id in self.memberships.get(player, ()):
+            self.guilds[guild_id].update(player, balance)
+
+    def guild(self, guild_id, members):
+        """
+        The board for `guild_id`, built from the ids in `members` if new.
+        """
+        board = self.guilds.get(guild_id)
+        if board is None:
+            scores = self.everyone.scores
+            members = self.members[guild_id] = set(members)
+            board = self.guilds[guild_id] = Leaderboard({m: scores[m] for m in members if m in scores})
+            for member in members:
+                self.memberships[member].add(guild_id)
+        return board
+
+    def join(self, guild_id, player):
+        board = self.guilds.get(guild_id)
+        if board is None:
+            return
+        self.members[guild_id].add(player)
+        self.memberships[player].add(guild_id)
+        bal = self.everyone.scores.get(player)
+        if bal is not None:
+            board.update(player, bal)
+
+    def leave(self, guild_id, player):
+        board = self.guilds.get(guild_id)
+        if board is None:
+            return
+        board.discard(player)
+        self.members[guild_id].discard(player)
+        self._unlink(guild_id, player)
+
+    def forget(self, guild_id):
+        if self.guilds.pop(guild_id, None) is None:
+            return
+        for player in self.members.pop(guild_id):
+            self._unlink(guild_id, player)
+
+    def _unlink(self, guild_id, player):
+        guilds = self.memberships.get(player)
+        if guilds is not None:
+            guilds.discard(guild_id)
+            if not guilds:
+                del self.memberships[player]
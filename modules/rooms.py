@@ -0,0 +1,136 @@
+import asyncio
+import json
+from os.path import exists
+
+from modules.metrics import persist_latency
+from modules.journal import GroupCommit
+
+ROOM_LOG = "rooms.journal"
+
+# Rewrite the log with only the open rooms after this many records, or as
+# many as the last rewrite kept if that is more
+COMPACT_THRESHOLD = 5000
+
+OP_OPEN = "o"
+OP_MESSAGE = "m"
+OP_BET = "b"
+OP_CLOSE = "c"
+
+# Open records written before rooms had their own ids
+LEGACY_OPEN_LEN = 7
+
+class RoomLog():
+    """
+    Append-only log of open betting rooms, so stakes already withdrawn
+    survive a restart.
+
+    Each record is one compact JSON array per line:
+    `["o", room, channel, title, outcomes, author, author_name, created, lock_at, expires]`,
+    `["m", room, message_id]`, `["b", room, player, player_name, outcome, amount, ts]`
+    and `["c", room]`. Logs from before rooms had ids open with the
+    shorter `["o", channel, title, outcomes, author, author_name, created]`
+    and key every record by channel; those rooms replay with the channel
+    id as their room id. Writes are buffered and group-committed like
+    `WalletJournal`, and the log is periodically rewritten to hold only the
+    rooms still open (see `snapshot_fn`).
+    """
+    def __init__(self, path=ROOM_LOG):
+        self.path = path
+        self.snapshot_fn = None
+        self.since_compact = 0
+        # records the last compaction kept
+        self.live = 0
+        self.log = GroupCommit(path, self.commit)
+
+    def replay(self):
+        """
+        Rebuild `{room: (open record, message_id, [bet records])}` for
+        every room that was never closed, with open records in the current
+        layout. A torn trailing record is cut off.
+        """
+        rooms = {}
+        if not exists(self.path):
+            return rooms
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                end += len(line)
+                (op, room) = record[:2]
+                if op == OP_OPEN:
+                    if len(record) == LEGACY_OPEN_LEN:
+                        record = [OP_OPEN, room, room] + record[2:] + [None, None]
+                    rooms[room] = (record, None, [])
+                elif op == OP_MESSAGE and room in rooms:
+                    (opened, _, bets) = rooms[room]
+                    rooms[room] = (opened, record[2], bets)
+                elif op == OP_BET and room in rooms:
+                    rooms[room][2].append(record)
+                elif op == OP_CLOSE:
+                    rooms.pop(room, None)
+                self.since_compact += 1
+        self.log.trim(end)
+        return rooms
+
+    def open_room(self, room):
+        self._record(open_record(room))
+
+    def set_message(self, room_id, message_id):
+        self._record([OP_MESSAGE, room_id, message_id])
+
+    def add_bet(self, room_id, bet, ts):
+        self._record(bet_record(room_id, bet, ts))
+
+    def close_room(self, room_id):
+        self._record([OP_CLOSE, room_id])
+
+    def _record(self, record):
+        self.log.add(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def commit(self, compact=False):
+        async with self.log.lock:
+            records = self.log.pending
+            self.log.pending = []
+            self.since_compact += len(records)
+            snapshot = None
+            # at most as many dead records as appended ones, so this keeps the log
+            # within about twice the open rooms however many bets they hold
+            due = self.since_compact >= max(COMPACT_THRESHOLD, self.live)
+            if self.snapshot_fn is not None and (compact or due):
+                # taken in the same tick as `records`, so it already includes them
+                snapshot = self.snapshot_fn()
+                self.since_compact = 0
+                self.live = len(snapshot)
+            if not records and snapshot is None:
+                return
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._write, records, snapshot)
+
+    def _write(self, records, snapshot):
+        with persist_latency.time(store="rooms"):
+            self._write_records(records, snapshot)
+
+    def _write_records(self, records, snapshot):
+        if snapshot is not None:
+            self.log.replace("".join(json.dumps(r, separators=(",", ":")) + "\n" for r in snapshot))
+            return
+
+        self.log.append("".join(records))
+
+    async def close(self):
+        self.log.stop()
+        await self.commit(compact=True)
+        self.log.close_file()
+
+def open_record(room):
+    return [
+        OP_OPEN, room.id, room.channel, room.title, room.outcomes,
+        room.author, room.author_name, room.created, room.lock_at, room.expires]
+
+def bet_record(room_id, bet, ts):
+    return [OP_BET, room_id, bet.player, bet.player_name, bet.outcome, bet.amount, ts]
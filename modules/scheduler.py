@@ -0,0 +1,124 @@
+import asyncio
+import math
+import time
+
+# Timer resolution in seconds
+TICK = 1.0
+# Each level of the wheel has 1 << WHEEL_BITS slots; four levels of 64 one
+# second slots reach about 194 days, anything later waits in `overflow`
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+MASK = WHEEL_SIZE - 1
+LEVELS = 4
+
+class Timer:
+    __slots__ = ("wheel", "tick", "callback", "slot")
+
+    def __init__(self, wheel, tick, callback) -> None:
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.slot = None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel shared by everything with a wall-clock
+    deadline. Level 0 has a slot per tick; each level above has slots
+    WHEEL_SIZE times as wide, and its timers are cascaded one level down
+    as their slot comes around. Scheduling and cancelling are O(1), and
+    a tick only touches the timers that are due or cascading, however
+    many are pending. While nothing is scheduled the wheel stops ticking.
+
+    Callbacks run on the event loop and must not block; start a task for
+    anything async.
+    """
+    def __init__(self, tick=TICK) -> None:
+        self.tick = tick
+        self.levels = [[set() for _ in range(WHEEL_SIZE)] for _ in range(LEVELS)]
+        self.overflow = set()
+        self.current = int(time.time() / tick)
+        self.count = 0
+        self.handle = None
+
+    def schedule(self, when, callback):
+        """
+        Call `callback()` on the first tick at or after the unix time `when`.
+        """
+        self._catch_up()
+        timer = Timer(self, max(math.ceil(when / self.tick), self.current + 1), callback)
+        self._place(timer)
+        self.count += 1
+        if self.handle is None:
+            self._arm()
+        return timer
+
+    def _place(self, timer):
+        delta = timer.tick - self.current
+        for level in range(LEVELS):
+            if delta < WHEEL_SIZE << (WHEEL_BITS * level):
+                slot = self.levels[level][(timer.tick >> (WHEEL_BITS * level)) & MASK]
+                break
+        else:
+            slot = self.overflow
+        slot.add(timer)
+        timer.slot = slot
+
+    def _catch_up(self):
+        # an empty wheel doesn't tick, so jump straight to now
+        if self.count == 0:
+            self.current = max(self.current, int(time.time() / self.tick))
+
+    def _arm(self):
+        loop = asyncio.get_event_loop()
+        delay = (self.current + 1) * self.tick - time.time()
+        self.handle = loop.call_later(max(delay, 0), self._run)
+
+    def _run(self):
+        self.handle = None
+        now = int(time.time() / self.tick)
+        while self.current < now and self.count > 0:
+            self._step()
+        self._catch_up()
+        if self.count > 0:
+            self._arm()
+
+    def _step(self):
+        self.current += 1
+        t = self.current
+        if t % (WHEEL_SIZE << (WHEEL_BITS * (LEVELS - 1))) == 0:
+            self._cascade(self.overflow)
+        # a boundary of level n is also one of every level below it, so go top down
+        for level in reversed(range(1, LEVELS)):
+            if t & ((1 << (WHEEL_BITS * level)) - 1) == 0:
+                self._cascade(self.levels[level][(t >> (WHEEL_BITS * level)) & MASK])
+
+        slot = self.levels[0][t & MASK]
+        due = [timer for timer in slot if timer.tick <= t]
+        for timer in due:
+            timer.cancel()
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"Error in scheduled callback: {e}")
+
+    def _cascade(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._place(timer)
+
+    def __len__(self):
+        return self.count
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+wheel = TimingWheel()
@@ -0,0 +1,223 @@
+import asyncio
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.metrics import persist_latency, errors
+from modules.journal import WalletJournal, SNAPSHOT_FILE, JOURNAL_FILE, OP_NEW, OP_WITHDRAW, OP_DEPOSIT
+
+WALLET_DB = "wallets.db"
+# Seconds a shared database waits on another process's write lock
+BUSY_TIMEOUT = 30
+
+# Why a transaction was refused by `WalletStore.transact`
+NO_WALLET = "no_wallet"
+INSUFFICIENT = "insufficient"
+
+class WalletStore():
+    """
+    Storage backend behind `WalletManager`.
+
+    A transaction is a list of `(op, player, amt)` tuples that the
+    manager has already validated; `submit` must apply all of them or none.
+    Eager stores hand every balance over from `load`, lazy stores return
+    None there and answer `fetch` one player at a time. `load` runs on a
+    worker thread while the bot connects, so it must only do file work.
+
+    Stores that other processes write to are not `cached`: the manager
+    keeps no balances of its own and hands every transaction to
+    `transact`, which checks and applies it atomically in the store.
+    """
+    lazy = False
+    cached = True
+
+    def load(self, snapshot_fn):
+        return {}
+
+    async def fetch(self, player):
+        return None
+
+    async def scan(self):
+        """
+        Every balance, for stores that `load` nothing up front.
+        """
+        return {}
+
+    def submit(self, ops):
+        raise NotImplementedError
+
+    async def transact(self, ops):
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+class TextWalletStore(WalletStore):
+    """
+    The default store: `wallets.txt` snapshot plus the group-committed journal.
+    """
+    def __init__(self, snapshot_file=SNAPSHOT_FILE, journal_file=JOURNAL_FILE):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.journal = WalletJournal(None, snapshot_file, journal_file)
+
+    def load(self, snapshot_fn):
+        self.journal.snapshot_fn = snapshot_fn
+        return self.journal.replay()
+
+    def submit(self, ops):
+        self.journal.record(ops)
+
+    async def flush(self):
+        await self.journal.commit()
+
+    async def close(self):
+        await self.journal.close()
+
+class SqliteWalletStore(WalletStore):
+    """
+    SQLite store in WAL mode. All database work runs on one dedicated
+    thread, so transactions are applied in submission order and never
+    block the event loop. Balances are read lazily per player.
+
+    With `shared`, several bot processes use the same file: balances are
+    never cached, and each transaction is checked and written under
+    SQLite's write lock (`BEGIN IMMEDIATE`), which serialises them
+    across processes.
+    """
+    lazy = True
+
+    def __init__(self, path=WALLET_DB, shared=False):
+        self.path = path
+        self.cached = not shared
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wallet-db")
+        self.conn = None
+        self.last = None
+        # runs before anything else queued on the db thread, no need to wait for it
+        self.executor.submit(self._connect).add_done_callback(_report)
+
+    def _connect(self):
+        self.conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False, timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS wallets (player INTEGER PRIMARY KEY, balance INTEGER NOT NULL)")
+
+    def load(self, snapshot_fn):
+        return None
+
+    async def fetch(self, player):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._fetch, player)
+
+    async def scan(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._scan)
+
+    def _scan(self):
+        return dict(self.conn.execute("SELECT player, balance FROM wallets"))
+
+    def _fetch(self, player):
+        row = self.conn.execute("SELECT balance FROM wallets WHERE player = ?", (player,)).fetchone()
+        return row[0] if row else None
+
+    def submit(self, ops):
+        self.last = self.executor.submit(self._apply, ops)
+        self.last.add_done_callback(_report)
+
+    def _apply(self, ops):
+        with persist_latency.time(store="sqlite"):
+            self._apply_ops(ops)
+
+    def _apply_ops(self, ops):
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for op, player, amt in ops:
+                if op == OP_NEW:
+                    cur.execute("INSERT OR REPLACE INTO wallets (player, balance) VALUES (?, ?)", (player, amt))
+                elif op == OP_WITHDRAW:
+                    cur.execute(
+                        "UPDATE wallets SET balance = balance - ? WHERE player = ? AND balance >= ?",
+                        (amt, player, amt))
+                elif op == OP_DEPOSIT:
+                    cur.execute("UPDATE wallets SET balance = balance + ? WHERE player = ?", (amt, player))
+                if cur.rowcount != 1:
+                    raise sqlite3.IntegrityError(f"wallet op {op} {player} {amt} did not apply")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    async def transact(self, ops):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._transact, ops)
+
+    def _transact(self, ops):
+        """
+        Returns None once `ops` are committed, or NO_WALLET/INSUFFICIENT
+        if they were refused and nothing was written.
+        """
+        with persist_latency.time(store="sqlite"):
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                staged = {}
+                for op, player, amt in ops:
+                    if op == OP_NEW:
+                        staged[player] = amt
+                        continue
+                    bal = staged[player] if player in staged else self._fetch(player)
+                    if bal is None:
+                        cur.execute("ROLLBACK")
+                        return NO_WALLET
+                    if op == OP_WITHDRAW:
+                        if bal < amt:
+                            cur.execute("ROLLBACK")
+                            return INSUFFICIENT
+                        staged[player] = bal - amt
+                    else:
+                        staged[player] = bal + amt
+                cur.executemany(
+                    "INSERT OR REPLACE INTO wallets (player, balance) VALUES (?, ?)", staged.items())
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        if self.last is not None:
+            await asyncio.wrap_future(self.last)
+
+    async def close(self):
+        await self.flush()
+        self.executor.submit(self.conn.close).result()
+        self.executor.shutdown()
+
+def _report(future):
+    if future.exception() is not None:
+        errors.inc(where="wallet_store")
+        print(f"Error writing wallet transaction: {future.exception()}")
+
+def import_text_store(db_path=WALLET_DB, snapshot_file=SNAPSHOT_FILE, journal_file=JOURNAL_FILE):
+    """
+    One-shot conversion of the text snapshot and journal into a SQLite store.
+    """
+    balances = WalletJournal(None, snapshot_file, journal_file).replay()
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS wallets (player INTEGER PRIMARY KEY, balance INTEGER NOT NULL)")
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO wallets (player, balance) VALUES (?, ?)", balances.items())
+    conn.close()
+    return len(balances)
+
+if __name__ == "__main__":
+    # python -m modules.store [wallets.db]
+    db_path = sys.argv[1] if len(sys.argv) > 1 else WALLET_DB
+    count = import_text_store(db_path)
+    print(f"Imported {count} wallets into {db_path}")
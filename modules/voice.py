@@ -0,0 +1,146 @@
+import asyncio
+
+import discord
+
+from modules.metrics import errors
+
+# Seconds a voice connection may sit with nothing playing before it is closed
+VOICE_IDLE_TIMEOUT = 120
+# Seconds to wait for a (re)connect before giving up on it
+CONNECT_TIMEOUT = 15
+
+class VoiceSession:
+    __slots__ = ("channel", "client", "lock", "timer", "playing")
+
+    def __init__(self, channel) -> None:
+        self.channel = channel
+        self.client = None
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.playing = False
+
+    @property
+    def connected(self):
+        return self.client is not None and self.client.is_connected()
+
+class VoiceSessions:
+    """
+    One tracked voice connection per guild. The connection is kept for
+    as long as songs keep coming, reconnected to the same channel if it
+    drops between songs, and closed once nothing has played for
+    `idle_timeout` seconds.
+    """
+    def __init__(self, idle_timeout=VOICE_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = float(idle_timeout or VOICE_IDLE_TIMEOUT)
+        self.sessions = {}
+
+    def active(self, guild_id):
+        session = self.sessions.get(guild_id)
+        return session is not None and session.connected
+
+    async def connect(self, channel):
+        """
+        Join `channel`, reusing or moving this guild's connection if it has one.
+        """
+        session = self.sessions.get(channel.guild.id)
+        if session is None:
+            session = self.sessions[channel.guild.id] = VoiceSession(channel)
+        session.channel = channel
+        async with session.lock:
+            if session.connected:
+                if session.client.channel != channel:
+                    await session.client.move_to(channel)
+            else:
+                try:
+                    await self._connect(session)
+                except Exception:
+                    if self.sessions.get(channel.guild.id) is session:
+                        self._forget(channel.guild.id, session)
+                    raise
+        if not session.playing:
+            self._arm(channel.guild.id, session)
+        return session.client
+
+    async def ensure(self, guild_id):
+        """
+        The guild's connected client, reconnecting first if it dropped.
+        None if there is no session or it can't be brought back.
+        """
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return None
+        async with session.lock:
+            if session.connected:
+                return session.client
+            try:
+                await self._connect(session)
+            except (asyncio.TimeoutError, discord.DiscordException) as e:
+                errors.inc(where="voice_reconnect")
+                print(f"Error reconnecting voice in guild {guild_id}: {e}")
+                return None
+        return session.client
+
+    async def _connect(self, session):
+        stale = session.channel.guild.voice_client
+        if stale is not None:
+            # a dropped client stays registered and would make connect() refuse
+            await stale.disconnect(force=True)
+        session.client = await session.channel.connect(timeout=CONNECT_TIMEOUT)
+
+    def busy(self, guild_id):
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return
+        session.playing = True
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+
+    def idle(self, guild_id):
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return
+        session.playing = False
+        self._arm(guild_id, session)
+
+    def _arm(self, guild_id, session):
+        if session.timer is not None:
+            session.timer.cancel()
+        loop = asyncio.get_event_loop()
+        session.timer = loop.call_later(
+            self.idle_timeout, lambda: asyncio.ensure_future(self.disconnect(guild_id)))
+
+    def dropped(self, guild_id):
+        """
+        Forget the session after the bot was removed from voice from outside.
+        """
+        session = self.sessions.get(guild_id)
+        # our own reconnects disconnect the stale client too; those keep their session
+        if session is not None and not session.lock.locked() and not session.connected:
+            self._forget(guild_id, session)
+
+    async def disconnect(self, guild_id):
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return
+        self._forget(guild_id, session)
+        if session.client is not None:
+            try:
+                await session.client.disconnect()
+            except discord.DiscordException as e:
+                print(f"Error disconnecting voice in guild {guild_id}: {e}")
+
+    def _forget(self, guild_id, session):
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        del self.sessions[guild_id]
+
+    async def close(self):
+        await asyncio.gather(*(self.disconnect(guild_id) for guild_id in list(self.sessions)))
+
+    def __contains__(self, guild_id):
+        return guild_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,12 +1,22 @@
 import asyncio
+import time
+
 import discord
-from os.path import exists
 from discord.ext import commands
 
 from modules.errors import InvalidCommandUsage
 from modules.embed import COLOUR
+from modules.outbox import outbox
+from modules.journal import OP_NEW, OP_WITHDRAW, OP_DEPOSIT
+from modules.store import TextWalletStore, NO_WALLET, INSUFFICIENT
+from modules.ranking import Leaderboards
+
+# Players hash onto this many locks, so transactions on unrelated players
+# almost never wait on each other
+LOCK_STRIPES = 64
 
-WALLET_FILE = "wallets.txt"
+LEADERBOARD_PAGE = 10
+HISTORY_PAGE = 10
 
 class WalletTransactionError(Exception):
     def __init__(self, msg):
@@ -27,58 +37,193 @@ class WalletManager():
     """
     Manages the balances for all players.
 
-    TODO: there might be some async conflicts here.
-    Make sure the lock is used properly if these appear.
+    Balances are cached in memory and every change is handed to a
+    `WalletStore` as one transaction. Lazy stores are read a player
+    at a time on first use.
+
+    A transaction holds the striped locks of every player it touches,
+    taken in stripe order, from loading through check-and-debit.
+    Snapshots are copy-on-write: the next transaction after a snapshot
+    writes to a fresh dict, so persistence can read it off-loop untouched.
+
+    `start` reads the store on a worker thread, so the bot can connect
+    while balances load; every operation waits for that to finish.
+
+    With a store that isn't `cached` (shared between shard processes)
+    nothing is kept here: reads and transactions go straight to the store.
+
+    `leaderboards` ranks every wallet and is updated by each transaction,
+    so the rank commands never sort. It is built in the background once
+    the store has loaded, scanning a lazy store off the startup path, and
+    `ranked` waits for it. It stays None for stores that aren't `cached`,
+    since other processes' transactions would never reach it.
+
+    Given a `Ledger`, every transaction is also recorded there with its
+    reason, one entry per player touched. Like the leaderboards it needs
+    a `cached` store.
     """
-    def __init__(self):
-        self.balances = self.load_balances()
-        self.lock = asyncio.Lock()
-
-    def balance(self, player):
-        if player in self.balances:
-            return self.balances[player]
-        else:
-            return None
-
-    def withdraw(self, player, amt):
-        if player not in self.balances:
-            raise NoWalletError()
-        
-        if self.balances[player] < amt:  
-            raise InsufficientFundsError()
-        
-        self.balances[player] -= amt
-    
-    def deposit(self, player, amt):
-        if player not in self.balances:
-            raise NoWalletError()
-        
-        self.balances[player] += amt
+    def __init__(self, store=None, ledger=None):
+        self.store = store or TextWalletStore()
+        self.ledger = ledger
+        self.balances = {}
+        self.shared = False
+        self.locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+        self.leaderboards = None
+        self.ranking = None
+        # changes made while the leaderboards are being built
+        self.unranked = None
+        self.loading = None
+        self.loaded = False
+
+    def start(self, loop=None):
+        if self.loading is None:
+            loop = loop or asyncio.get_event_loop()
+            self.loading = asyncio.ensure_future(self._start(loop), loop=loop)
+        return self.loading
+
+    async def _start(self, loop):
+        balances = await loop.run_in_executor(None, self.store.load, self.snapshot)
+        self.balances = balances or {}
+        if self.store.cached:
+            if self.ledger is not None:
+                # a new ledger opens with every balance, the only reason to scan a lazy store up front
+                if balances is None and self.ledger.empty():
+                    balances = await self.store.scan()
+                await loop.run_in_executor(None, self.ledger.load, balances or {})
+                await self.ledger.commit()
+            self.ranking = asyncio.ensure_future(self._rank(loop, balances), loop=loop)
+        self.loaded = True
+
+    async def _rank(self, loop, balances):
+        if balances is None:
+            balances = await self.store.scan()
+        # anything already in memory is at least as new as the scan
+        ranked = dict(balances)
+        ranked.update(self.balances)
+        self.unranked = {}
+        boards = await loop.run_in_executor(None, Leaderboards, ranked)
+        for player, bal in self.unranked.items():
+            boards.update(player, bal)
+        self.unranked = None
+        self.leaderboards = boards
+
+    async def ranked(self):
+        """
+        The leaderboards, once built; None if they aren't kept.
+        """
+        await self.ready()
+        if self.ranking is not None:
+            await self.ranking
+        return self.leaderboards
+
+    async def ready(self):
+        if not self.loaded:
+            await self.start()
+
+    async def _load(self, player):
+        await self.ready()
+        if not self.store.cached:
+            return await self.store.fetch(player)
+        if player not in self.balances and self.store.lazy:
+            bal = await self.store.fetch(player)
+            # another coroutine may have loaded and spent it while we waited
+            if bal is not None and player not in self.balances:
+                self._writable()[player] = bal
+        return self.balances.get(player)
+
+    async def balance(self, player):
+        return await self._load(player)
+
+    async def withdraw(self, player, amt, reason="other"):
+        await self.transact([(OP_WITHDRAW, player, amt)], reason)
     
-    def new_wallet(self, player):
-        self.balances[player] = 0
-
-    @staticmethod
-    def load_balances():
-        if exists(WALLET_FILE):
-            with open(WALLET_FILE) as f:
-                entries = f.read().splitlines()
-                out = {}
-                for entry in entries:
-                    [player, bal] = entry.split("=")
-                    out[int(player)] = int(bal)
-                return out
-        else:
-            return {}
+    async def deposit(self, player, amt, reason="other"):
+        await self.transact([(OP_DEPOSIT, player, amt)], reason)
     
-    async def persist(self, *args, **kwargs):
-        await self.lock.acquire()
-        with open(WALLET_FILE, "w") as f:
-            out = ""
-            for player, bal in self.balances.items():
-                out += f"{player}={bal}\n"
-            f.write(out)
-        self.lock.release()
+    async def new_wallet(self, player, amt=0, reason="welcome"):
+        await self.transact([(OP_NEW, player, amt)], reason)
+
+    async def settle(self, payouts, reason="payout"):
+        """
+        Pay out a list of `(player, amt)` in a single atomic transaction.
+        """
+        await self.transact([(OP_DEPOSIT, player, amt) for player, amt in payouts], reason)
+
+    async def transact(self, ops, reason="other"):
+        """
+        Apply a list of `(op, player, amt)` all-or-nothing. Every op is
+        checked before any balance changes, so a failure leaves no partial state.
+        `reason` is one of `ledger.REASONS`.
+        """
+        if not self.store.cached:
+            await self.ready()
+            refused = await self.store.transact(ops)
+            if refused == NO_WALLET:
+                raise NoWalletError()
+            if refused == INSUFFICIENT:
+                raise InsufficientFundsError()
+            return
+
+        stripes = sorted({hash(player) % LOCK_STRIPES for _, player, _ in ops})
+        for idx in stripes:
+            await self.locks[idx].acquire()
+        try:
+            self._apply(await self._stage(ops), ops, reason)
+        finally:
+            for idx in reversed(stripes):
+                self.locks[idx].release()
+
+    async def _stage(self, ops):
+        for _, player, _ in ops:
+            await self._load(player)
+
+        staged = {}
+        for op, player, amt in ops:
+            if op == OP_NEW:
+                staged[player] = amt
+                continue
+
+            bal = staged.get(player, self.balances.get(player))
+            if bal is None:
+                raise NoWalletError()
+            if op == OP_WITHDRAW:
+                if bal < amt:
+                    raise InsufficientFundsError()
+                staged[player] = bal - amt
+            else:
+                staged[player] = bal + amt
+        return staged
+
+    def _apply(self, staged, ops, reason):
+        if not ops:
+            return
+        if self.ledger is not None:
+            self.ledger.record(
+                [(player, bal - self.balances.get(player, 0), bal) for player, bal in staged.items()], reason)
+        self._writable().update(staged)
+        if self.leaderboards is not None:
+            for player, bal in staged.items():
+                self.leaderboards.update(player, bal)
+        elif self.unranked is not None:
+            self.unranked.update(staged)
+        self.store.submit(ops)
+
+    def _writable(self):
+        if self.shared:
+            self.balances = dict(self.balances)
+            self.shared = False
+        return self.balances
+
+    def snapshot(self):
+        self.shared = True
+        return self.balances
+
+    async def close(self):
+        # compacting before the snapshot loaded would write out an empty wallet file
+        await self.ready()
+        if self.ledger is not None:
+            await self.ledger.close()
+        await self.store.close()
 
 class WalletModule(commands.Cog):
     """
@@ -94,30 +239,123 @@ class WalletModule(commands.Cog):
     async def balance(self, ctx):
         player = ctx.author.id
         name = ctx.author.name
-        balance = self.wallet.balance(player)
+        balance = await self.wallet.balance(player)
         if balance is None:
             embed = discord.Embed(title=f"{name} you dont have a Chimp-wallet yet!", color=COLOUR)
             embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
-            await ctx.send(embed=embed)
+            outbox.post(ctx.channel, embed=embed)
             return
         
         dm = self.bot.get_user(player) or await self.bot.fetch_user(player)
         embed = discord.Embed(title=f"{name} you have a balance of {balance} Chimp-coins", color=COLOUR)
-        await dm.send(embed=embed)
+        outbox.post(dm, embed=embed)
     
+    @commands.command(name="history")
+    async def history(self, ctx, page: int=1):
+        player = ctx.author.id
+        name = ctx.author.name
+        await self.wallet.ready()
+        ledger = self.wallet.ledger
+        if ledger is None:
+            raise InvalidCommandUsage("Wallet history is not being recorded")
+        count = ledger.count(player)
+        if count == 0:
+            embed = discord.Embed(title=f"{name} has no Chimp-coin history yet", color=COLOUR)
+            outbox.post(ctx.channel, embed=embed)
+            return
+
+        pages = (count + HISTORY_PAGE - 1) // HISTORY_PAGE
+        page = min(max(page, 1), pages)
+        entries = await ledger.history(player, (page - 1) * HISTORY_PAGE, HISTORY_PAGE)
+        lines = "".join(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(ts))} {reason} {change:+} → {balance}\n"
+            for ts, change, balance, reason in entries)
+        embed = discord.Embed(title=f"{name}'s Chimp-coin history", description=lines, color=COLOUR)
+        embed.set_footer(text=f"Page {page} of {pages} • newest first, times in UTC")
+        dm = self.bot.get_user(player) or await self.bot.fetch_user(player)
+        outbox.post(dm, embed=embed)
+
     @commands.command(name="new-wallet")
     async def new_wallet(self, ctx):
         player = ctx.author.id
         name = ctx.author.name
-        if self.wallet.balance(player) is not None:
+        if await self.wallet.balance(player) is not None:
             raise InvalidCommandUsage(f"{name} already has a Chimp-wallet!")
         
-        self.wallet.new_wallet(player)
-        self.wallet.deposit(player, 500)
+        await self.wallet.new_wallet(player, 500)
         embed = discord.Embed(title=f"Welcome {name} to Chimp-betting!", color=COLOUR)
         embed.set_footer(text="Heres 500 Chimp-coins to get you started")
-        await ctx.send(embed=embed)
-    
-    @new_wallet.after_invoke
-    async def persist_changes(self, ctx):
-        await self.wallet.persist()
\ No newline at end of file
+        outbox.post(ctx.channel, embed=embed)
+
+    async def boards(self, guild):
+        """
+        The leaderboard for `guild` (None in DMs) and the global one.
+        """
+        boards = await self.wallet.ranked()
+        if boards is None:
+            raise InvalidCommandUsage("The leaderboard is not kept while shards share wallets")
+        if guild is None:
+            return (boards.everyone, boards.everyone)
+        return (boards.guild(guild.id, (member.id for member in guild.members)), boards.everyone)
+
+    def player_name(self, player):
+        user = self.bot.get_user(player)
+        return user.name if user is not None else f"<@{player}>"
+
+    async def send_board(self, ctx, board, title, page):
+        if len(board) == 0:
+            embed = discord.Embed(title="Nobody has a Chimp-wallet yet", color=COLOUR)
+            embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
+            outbox.post(ctx.channel, embed=embed)
+            return
+        pages = (len(board) + LEADERBOARD_PAGE - 1) // LEADERBOARD_PAGE
+        page = min(max(page, 1), pages)
+        start = (page - 1) * LEADERBOARD_PAGE
+        lines = "".join(
+            f"{start + i}. {self.player_name(player)} ({bal})\n"
+            for i, (player, bal) in enumerate(board.top(start, start + LEADERBOARD_PAGE), 1))
+        embed = discord.Embed(title=title, description=lines, color=COLOUR)
+        embed.set_footer(text=f"Page {page} of {pages} • `$rank` to see where you stand")
+        outbox.post(ctx.channel, embed=embed, key="leaderboard")
+
+    @commands.command(name="leaderboard")
+    async def leaderboard(self, ctx, page: int=1):
+        (board, _) = await self.boards(ctx.guild)
+        title = f"Richest apes in {ctx.guild.name}" if ctx.guild is not None else "Richest apes"
+        await self.send_board(ctx, board, title, page)
+
+    @commands.command(name="leaderboard-global")
+    async def leaderboard_global(self, ctx, page: int=1):
+        (_, board) = await self.boards(ctx.guild)
+        await self.send_board(ctx, board, "Richest apes anywhere", page)
+
+    @commands.command(name="rank")
+    async def rank(self, ctx):
+        player = ctx.author.id
+        name = ctx.author.name
+        (board, everyone) = await self.boards(ctx.guild)
+        rank = everyone.rank(player)
+        if rank is None:
+            embed = discord.Embed(title=f"{name} you dont have a Chimp-wallet yet!", color=COLOUR)
+            embed.set_footer(text="Type `$new-wallet` to get a wallet with some welcome Chimp-coins")
+            outbox.post(ctx.channel, embed=embed)
+            return
+        embed = discord.Embed(title=f"{name} is #{rank} of {len(everyone)} overall", color=COLOUR)
+        if ctx.guild is not None:
+            embed.set_footer(text=f"#{board.rank(player)} of {len(board)} in {ctx.guild.name}")
+        outbox.post(ctx.channel, embed=embed)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if self.wallet.leaderboards is not None:
+            self.wallet.leaderboards.join(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if self.wallet.leaderboards is not None:
+            self.wallet.leaderboards.leave(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        if self.wallet.leaderboards is not None:
+            self.wallet.leaderboards.forget(guild.id)